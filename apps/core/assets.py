@@ -2,7 +2,7 @@
 #--- Author: Dmitri Patrakov <traditio@gmail.com>
 from django_assets import Bundle, register
 
-js = Bundle('coffee/sample.coffee', filters='coffeescript', output='gen/all.js')
+js = Bundle('coffee/sample.coffee', 'coffee/autocomplete.coffee', filters='coffeescript', output='gen/all.js')
 
 css = Bundle('scss/screen.scss', 'scss/print.scss', 'scss/ie.scss', filters='compass', output='gen/all.css')
 
@@ -0,0 +1,247 @@
+#coding=utf-8
+import random
+import shutil
+import tempfile
+import warnings
+from bisect import bisect
+from optparse import make_option
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import CacheKeyWarning
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, models, reset_queries, transaction
+
+from libs import autocomplete
+from libs.autocomplete import AutocompleteModel
+from libs.ngram_index import fts5_available
+
+CYRILLIC = u'ка ло ми но ра се ту ва ен ов ск гр ан бо ре ди жу цы ща ёл'.split()
+LATIN = u'ka lo mi no ra se tu va en ov sk gr an bo re di zhu cy sha yo'.split()
+
+# сценарий: (название, аттрибуты модели, поля автокомплита)
+SCENARIOS = [
+    ('cache', {'autocomplete_backend': 'cache'}, ['name__startswith', 'name__istartswith']),
+    ('index', {'autocomplete_backend': 'index'}, ['name__startswith', 'name__istartswith']),
+    ('sstable', {'autocomplete_backend': 'sstable'}, ['name__startswith', 'name__istartswith']),
+    ('words', {'autocomplete_word_backend': 'memory'}, ['fio__words']),
+    ('fts', {'autocomplete_word_backend': 'fts'}, ['fio__words']),
+]
+
+
+def random_word(syllables):
+    word = u''.join(random.choice(syllables) for i in xrange(random.randint(2, 4)))
+    case = random.random()
+    if case < 0.75:
+        return word.capitalize()
+    if case < 0.85:
+        return word
+    if case < 0.95:
+        return word.upper()
+    # вроде McDonald
+    i = random.randint(1, len(word) - 1)
+    return word[:i].capitalize() + word[i:].capitalize()
+
+
+def random_row():
+    '''Название (одно-два слова) и ФИО, кириллицей или латиницей
+    '''
+    syllables = CYRILLIC if random.random() < 0.6 else LATIN
+    name = random_word(syllables)
+    if random.random() < 0.4:
+        name += random.choice(u' -') + random_word(syllables)
+    fio = u' '.join(random_word(syllables) for i in xrange(3))
+    return name, fio
+
+
+class Zipf(object):
+    '''Выбор номера от 0 до size - 1 с вероятностью, обратно пропорциональной (номер + 1) ** s
+    '''
+    def __init__(self, size, s):
+        self.cumulative = []
+        total = 0.0
+        for rank in xrange(1, size + 1):
+            total += 1.0 / rank ** s
+            self.cumulative.append(total)
+
+    def __call__(self):
+        return min(bisect(self.cumulative, random.random() * self.cumulative[-1]), len(self.cumulative) - 1)
+
+
+def keystrokes(values, field, count, zipf):
+    '''Запросы, которые уходят при наборе популярных значений по одной букве
+    '''
+    lookup = field.split('__')[1]
+    result = []
+    while len(result) < count:
+        value = values[zipf()]
+        if lookup == 'words':
+            value = value.lower()
+        elif lookup == 'istartswith':
+            # регистр набранного текста не совпадает с регистром значения
+            value = random.choice([value, value, value.lower(), value.upper()])
+        typed = random.randint(1, min(len(value), 8 if lookup != 'words' else 16))
+        result.extend(value[:i] for i in xrange(1, typed + 1))
+    return result[:count]
+
+
+def percentile(timings, p):
+    return timings[int(p * (len(timings) - 1))]
+
+
+class Command(BaseCommand):
+    help = u'Замеряет AutocompleteManager.find() и save() на разных способах хранения ' \
+           u'автокомплита. Создает временную таблицу со случайными названиями и ФИО ' \
+           u'(кириллица и латиница в разном регистре) и воспроизводит набор популярных ' \
+           u'(по закону Ципфа) значений по одной букве. Только для локальной SQLite и locmem кеша.'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', dest='rows', type='int', default=20000,
+            help=u'Сколько строк в таблице'),
+        make_option('--keystrokes', dest='keystrokes', type='int', default=10000,
+            help=u'Сколько запросов на каждое поле'),
+        make_option('--saves', dest='saves', type='int', default=200,
+            help=u'Сколько раз изменить и сохранить объект'),
+        make_option('--zipf', dest='zipf', type='float', default=1.1,
+            help=u'Показатель закона Ципфа для популярности значений'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help=u'Начальное значение генератора случайных чисел'),
+        make_option('--backends', dest='backends', default=','.join(s[0] for s in SCENARIOS),
+            help=u'Через запятую, из: %s' % ', '.join(s[0] for s in SCENARIOS)),
+        make_option('--ranked', dest='ranked', action='store_true', default=False,
+            help=u'Ранжировать подсказки по популярности (autocomplete_score_field)'),
+    )
+
+    def handle(self, **options):
+        if not connection.settings_dict['ENGINE'].endswith('sqlite3') or not hasattr(cache, '_cache'):
+            raise CommandError('Benchmark needs the sqlite database and the locmem cache backend')
+        names = options['backends'].split(',')
+        unknown = set(names) - set(s[0] for s in SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown backends: %s' % ', '.join(sorted(unknown)))
+        if 'fts' in names and not fts5_available():
+            names.remove('fts')
+
+        # ключи с пробелами в значении - предупреждение про memcached на каждый запрос
+        warnings.filterwarnings('ignore', category=CacheKeyWarning)
+        random.seed(options['seed'])
+        rows = [random_row() for i in xrange(options['rows'])]
+        # популярность: номер строки в случайном порядке
+        zipf = Zipf(len(rows), options['zipf'])
+        popular = range(len(rows))
+        random.shuffle(popular)
+        hits = [0] * len(rows)
+        for rank, i in enumerate(popular):
+            hits[i] = int(len(rows) / (rank + 1) ** options['zipf'])
+        ranked_rows = [rows[i] for i in popular]
+        workloads = {}
+        for field in ('name__startswith', 'name__istartswith', 'fio__words'):
+            column = 1 if field.startswith('fio') else 0
+            workloads[field] = keystrokes([row[column] for row in ranked_rows], field, options['keystrokes'], zipf)
+        saves = [(popular[zipf()] + 1, random_row()) for i in xrange(options['saves'])]
+
+        model = self._create_model()
+        debug, sstable_dir = settings.DEBUG, getattr(settings, 'AUTOCOMPLETE_SSTABLE_DIR', None)
+        fts_dir = getattr(settings, 'AUTOCOMPLETE_FTS_DIR', None)
+        # connection.queries заполняется только с DEBUG
+        settings.DEBUG = True
+        settings.AUTOCOMPLETE_SSTABLE_DIR = settings.AUTOCOMPLETE_FTS_DIR = tempfile.mkdtemp()
+        output = [
+            '%s rows, %s keystrokes per field, zipf s=%s, %s saves, cache max_entries=%s' % (len(rows),
+                options['keystrokes'], options['zipf'], options['saves'], cache._max_entries),
+            '%-8s %-18s %9s %9s %9s %11s %8s %10s %9s %8s' % ('backend', 'field', 'build ms', 'p50 us',
+                'p99 us', 'queries/1k', 'results', 'cache KB', 'save ms', 'save q'),
+        ]
+        try:
+            for name, attrs, fields in SCENARIOS:
+                if name not in names:
+                    continue
+                for attr, value in attrs.items():
+                    setattr(model, attr, value)
+                model.autocomplete_fields = fields
+                model.autocomplete_score_field = 'hits' if options['ranked'] else None
+                self._fill(model, rows, hits)
+                output.extend(self._run(name, model, fields, workloads, saves))
+        finally:
+            settings.DEBUG = debug
+            shutil.rmtree(settings.AUTOCOMPLETE_SSTABLE_DIR, True)
+            settings.AUTOCOMPLETE_SSTABLE_DIR, settings.AUTOCOMPLETE_FTS_DIR = sstable_dir, fts_dir
+            self._reset(model)
+            cursor = connection.cursor()
+            for sql in connection.creation.sql_destroy_model(model, {}, no_style()):
+                cursor.execute(sql)
+            transaction.commit_unless_managed()
+        return '\n'.join(output)
+
+    def _create_model(self):
+        model = type('AutocompleteBench', (AutocompleteModel,), {
+            '__module__': __name__,
+            'name': models.CharField(max_length=100),
+            'fio': models.CharField(max_length=200),
+            'hits': models.IntegerField(default=0),
+            'Meta': type('Meta', (), {'app_label': 'core', 'db_table': 'core_autocomplete_bench'}),
+        })
+        style = no_style()
+        cursor = connection.cursor()
+        sql, references = connection.creation.sql_create_model(model, style, set())
+        for statement in sql + connection.creation.sql_indexes_for_model(model, style):
+            cursor.execute(statement)
+        transaction.commit_unless_managed()
+        return model
+
+    def _fill(self, model, rows, hits):
+        table = connection.ops.quote_name(model._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % table)
+        cursor.executemany('INSERT INTO %s (id, name, fio, hits) VALUES (%%s, %%s, %%s, %%s)' % table,
+                [(i + 1, name, fio, hits[i]) for i, (name, fio) in enumerate(rows)])
+        transaction.commit_unless_managed()
+        self._reset(model)
+
+    def _reset(self, model):
+        '''Забыть все, что сценарий оставил в кеше и в памяти процесса
+        '''
+        cache.clear()
+        autocomplete._indexes.pop(model, None)
+        for registry in (autocomplete._fts_indexes, autocomplete._sstables):
+            for key in [key for key in registry if key[0] is model]:
+                del registry[key]
+
+    def _cache_bytes(self, model):
+        prefix = '%s.%s.' % (model.__module__, model.__name__)
+        return sum(len(key) + len(value) for key, value in cache._cache.items() if key.startswith(prefix))
+
+    def _run(self, name, model, fields, workloads, saves):
+        manager = model.autocomplete
+        start = time()
+        manager.rebuild()
+        build = time() - start
+
+        results = []
+        for field in fields:
+            timings, found = [], 0
+            reset_queries()
+            for q in workloads[field]:
+                start = time()
+                found += len(manager.find(field, q))
+                timings.append(time() - start)
+            queries = len(connection.queries)
+            timings.sort()
+            results.append([name, field, build * 1000, percentile(timings, 0.5) * 1e6,
+                percentile(timings, 0.99) * 1e6, queries * 1000.0 / len(timings), float(found) / len(timings)])
+        cache_kb = self._cache_bytes(model) / 1024.0
+
+        save_time = save_queries = 0
+        for pk, (value, fio) in saves:
+            obj = manager.get(pk=pk)
+            obj.name, obj.fio = value, fio
+            reset_queries()
+            start = time()
+            obj.save()
+            save_time += time() - start
+            save_queries += len(connection.queries)
+        count = len(saves) or 1
+
+        return ['%-8s %-18s %9.1f %9.1f %9.1f %11.1f %8.1f %10.1f %9.2f %8.1f' % tuple(
+            result + [cache_kb, save_time * 1000 / count, float(save_queries) / count]) for result in results]
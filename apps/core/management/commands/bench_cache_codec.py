@@ -0,0 +1,67 @@
+#coding=utf-8
+from optparse import make_option
+from time import time
+import cPickle as pickle
+
+from django.core.management.base import LabelCommand, CommandError
+from django.db.models import get_model
+
+from libs.cache import CachedQuerySet, encode
+
+
+class Command(LabelCommand):
+    help = u'Сравнивает, сколько места в кеше занимают объекты CachedModel и сколько ' \
+           u'времени уходит на их чтение: pickle объекта под каждым ключом против encode().'
+    args = '<app.Model app.Model ...>'
+    label = 'app.Model'
+    option_list = LabelCommand.option_list + (
+        make_option('--count', dest='count', type='int', default=1000,
+            help=u'Сколько объектов взять из базы'),
+        make_option('--protocol', dest='protocol', type='int', default=0,
+            help=u'Протокол pickle (python-memcached по умолчанию использует 0)'),
+    )
+
+    def handle_label(self, label, **options):
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError('Expected app.Model, got %s' % label)
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model %s' % label)
+        queryset = model._default_manager.get_query_set()
+        if not isinstance(queryset, CachedQuerySet):
+            raise CommandError('%s is not a CachedModel' % label)
+
+        objs = list(queryset.order_by('pk')[:options['count']])
+        if not objs:
+            raise CommandError('%s has no rows' % label)
+        protocol = options['protocol']
+        aliases = len(queryset.cached_attrs) - 1
+
+        pickled = [pickle.dumps(obj, protocol) for obj in objs]
+        encoded = [pickle.dumps(encode(obj), protocol) for obj in objs]
+        refs = [pickle.dumps(obj.pk, protocol) for obj in objs]
+
+        pickled_bytes = sum(map(len, pickled)) * (aliases + 1)
+        encoded_bytes = sum(map(len, encoded)) + sum(map(len, refs)) * aliases
+
+        start = time()
+        for data in pickled:
+            pickle.loads(data)
+        pickled_time = time() - start
+
+        start = time()
+        for data in encoded:
+            queryset._decode(pickle.loads(data))
+        encoded_time = time() - start
+
+        rows = len(objs)
+        return '\n'.join([
+            '%s: %s rows, %s keys per row, pickle protocol %s' % (label, rows, aliases + 1, protocol),
+            '%-8s %12s %12s %14s' % ('', 'bytes', 'bytes/row', 'decode us/row'),
+            '%-8s %12d %12.1f %14.2f' % ('pickle', pickled_bytes, float(pickled_bytes) / rows,
+                                         pickled_time * 1e6 / rows),
+            '%-8s %12d %12.1f %14.2f' % ('encode', encoded_bytes, float(encoded_bytes) / rows,
+                                         encoded_time * 1e6 / rows),
+        ])
@@ -0,0 +1,45 @@
+#coding=utf-8
+import os
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+from libs.autocomplete import AutocompleteManager
+
+
+class Command(BaseCommand):
+    help = u'Пишет таблицы строк (см. libs.sstable) для полей автокомплита моделей ' \
+           u'с autocomplete_backend = \'sstable\' в каталог AUTOCOMPLETE_SSTABLE_DIR. ' \
+           u'Без аргументов - для всех таких моделей.'
+    args = '[app.Model app.Model ...]'
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Expected app.Model, got %s' % label)
+                model = get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError('Unknown model %s' % label)
+                if not isinstance(getattr(model, 'autocomplete', None), AutocompleteManager):
+                    raise CommandError('%s is not an AutocompleteModel' % label)
+                models.append(model)
+        else:
+            models = [model for model in get_models()
+                      if isinstance(getattr(model, 'autocomplete', None), AutocompleteManager)]
+
+        output = []
+        for model in models:
+            manager = model.autocomplete
+            for field in manager._fields('sstable'):
+                start = time()
+                path = manager.build_sstable(field)
+                if verbosity:
+                    output.append('%s.%s %s: %s bytes in %.1f s' % (model._meta.app_label,
+                        model._meta.object_name, field, os.path.getsize(path), time() - start))
+        return '\n'.join(output)
@@ -0,0 +1,54 @@
+#coding=utf-8
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from libs.stats import CacheReporter, percentile, get_reporter
+from libs.cache import stats
+
+HIT_EVENTS = ('local_hit', 'hit', 'stale_hit', 'tombstone_hit', 'shared_hit')
+
+
+class Command(NoArgsCommand):
+    help = u'Выводит статистику кеша, собранную всеми процессами (см. libs.stats.CacheReporter), ' \
+           u'и при --reset обнуляет ее.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--namespace', dest='namespace', default=stats.namespace,
+            help=u'Пространство имен статистики'),
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help=u'Обнулить статистику после вывода'),
+    )
+
+    def handle_noargs(self, **options):
+        namespace = options['namespace']
+        reporter = get_reporter()
+        if not isinstance(reporter, CacheReporter):
+            reporter = CacheReporter()
+        elif namespace == stats.namespace:
+            # статистика этого процесса еще не отдана репортеру
+            stats.flush()
+        snapshot = reporter.collect(namespace)
+
+        names = sorted(set(name for name, event in snapshot['counters']) |
+                       set(name for name, event in snapshot['timings']))
+        output = []
+        for name in names:
+            counters = dict((event, count) for (_name, event), count in snapshot['counters'].iteritems()
+                            if _name == name)
+            hits = sum(counters.get(event, 0) for event in HIT_EVENTS)
+            total = hits + counters.get('miss', 0)
+            line = '%s: %s' % (name, ', '.join('%s=%s' % item for item in sorted(counters.iteritems())))
+            if total:
+                line += ', hit ratio %.1f%%' % (100.0 * hits / total)
+            output.append(line)
+            for (_name, event), timing in sorted(snapshot['timings'].iteritems()):
+                if _name == name:
+                    output.append('    %s: %s calls, avg %.2f ms, p50 %s ms, p99 %s ms, total %.0f ms' % (
+                        event, timing[0], timing[1] / timing[0],
+                        percentile(timing, 50), percentile(timing, 99), timing[1]))
+
+        if options['reset']:
+            reporter.reset(namespace)
+            if namespace == stats.namespace:
+                stats.reset()
+        return '\n'.join(output) or 'No statistics collected for %s' % namespace
@@ -0,0 +1,65 @@
+#coding=utf-8
+import os
+from optparse import make_option
+from time import time
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.template.loaders.app_directories import app_template_dirs
+
+
+def template_names(env, extensions=None):
+    '''Имена всех шаблонов окружения: у загрузчиков Jinja2, которые не умеют
+    их перечислять, - по файлам в TEMPLATE_DIRS и каталогах templates приложений
+    '''
+    try:
+        names = env.list_templates()
+    except TypeError:
+        names = set()
+        for directory in tuple(settings.TEMPLATE_DIRS) + tuple(app_template_dirs):
+            for root, dirs, files in os.walk(directory):
+                for filename in files:
+                    names.add(os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, '/'))
+        names = sorted(names)
+    if extensions:
+        names = [name for name in names if os.path.splitext(name)[1] in extensions]
+    return names
+
+
+class Command(NoArgsCommand):
+    help = u'Заранее компилирует все шаблоны (HAML -> Jinja2 -> байткод Python) в кеш байткода ' \
+           u'окружения coffin (bytecode_cache из JINJA2_ENVIRONMENT_OPTIONS, см. settings.py), ' \
+           u'что бы первые запросы после выкладки не ждали компиляции. Запускается при выкладке.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--extensions', dest='extensions', default='',
+            help=u'Через запятую, например .haml,.html (по умолчанию - все файлы шаблонов)'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+            help=u'Не очищать кеш перед компиляцией'),
+    )
+
+    def handle_noargs(self, **options):
+        from coffin.common import env
+        verbosity = int(options.get('verbosity', 1))
+        cache = env.bytecode_cache
+        if cache is None:
+            raise CommandError('Template bytecode cache is off, set bytecode_cache in JINJA2_ENVIRONMENT_OPTIONS')
+        if not options['keep']:
+            # jinja сверяет байткод только с исходником шаблона, настройки HAMLISH_* в этом не участвуют
+            cache.clear()
+
+        extensions = [extension.strip() for extension in options['extensions'].split(',') if extension.strip()]
+        output, errors = [], []
+        start = time()
+        names = template_names(env, extensions)
+        for name in names:
+            try:
+                env.get_template(name)
+            except Exception, e:
+                errors.append('%s: %s: %s' % (name, e.__class__.__name__, e))
+                continue
+            if verbosity > 1:
+                output.append(name)
+        output.append('%s templates compiled in %.1f s' % (len(names) - len(errors), time() - start))
+        if errors:
+            raise CommandError('\n'.join(output + ['Failed to compile:'] + errors))
+        return '\n'.join(output)
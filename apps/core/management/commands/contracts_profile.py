@@ -0,0 +1,58 @@
+#coding=utf-8
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from libs import contracts
+from libs.stats import CacheReporter, Stats, get_reporter
+
+NAMESPACE = 'contracts'
+
+
+class Command(NoArgsCommand):
+    help = u'Выводит функции, на проверки @takes/@returns которых уходит больше всего ' \
+           u'времени, по статистике всех процессов с CONTRACTS_PROFILE = True ' \
+           u'(см. libs.contracts.set_profiling), и при --reset обнуляет ее.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=20,
+            help=u'Сколько функций вывести'),
+        make_option('--sort', dest='sort', default='checks', choices=('checks', 'share', 'calls'),
+            help=u'Порядок: checks - по общему времени проверок, share - по доле проверок '
+                 u'во времени вызова, calls - по количеству вызовов'),
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help=u'Обнулить статистику после вывода'),
+    )
+
+    def handle_noargs(self, **options):
+        reporter = get_reporter()
+        if not isinstance(reporter, CacheReporter):
+            reporter = CacheReporter()
+        profiler = contracts.sampling.profiler
+        if isinstance(profiler, Stats) and profiler.namespace == NAMESPACE:
+            # статистика этого процесса еще не отдана репортеру
+            profiler.flush()
+        timings = reporter.collect(NAMESPACE)['timings']
+
+        rows = []
+        for name in set(name for name, event in timings):
+            checks = timings.get((name, 'checks'), [0, 0.0])
+            body = timings.get((name, 'body'), [0, 0.0])
+            calls = body[0]
+            total = checks[1] + body[1]
+            rows.append((name, calls, checks[1], body[1], checks[1] * 1000 / calls if calls else 0,
+                         100 * checks[1] / total if total else 0))
+        column = {'checks': 2, 'share': 5, 'calls': 1}[options['sort']]
+        rows.sort(key=lambda row: row[column], reverse=True)
+
+        output = []
+        if rows:
+            output.append('%-60s %10s %12s %12s %14s %8s' % ('function', 'calls', 'checks ms',
+                                                             'body ms', 'checks us/call', 'share'))
+            for row in rows[:options['limit']]:
+                output.append('%-60s %10d %12.1f %12.1f %14.2f %7.1f%%' % row)
+
+        if options['reset']:
+            reporter.reset(NAMESPACE)
+            if isinstance(profiler, Stats) and profiler.namespace == NAMESPACE:
+                profiler.reset()
+        return '\n'.join(output) or 'No contract profile collected, set CONTRACTS_PROFILE = True'
@@ -0,0 +1,177 @@
+#coding=utf-8
+import sys
+from multiprocessing import Pool
+from optparse import make_option
+from time import time, sleep
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.db.models import get_model, get_models, Min, Max
+
+from libs.autocomplete import AutocompleteManager, continuate_string_iterator
+from libs.cache import CachedQuerySet
+
+
+def _close_connections():
+    # после fork нельзя пользоваться соединениями родителя
+    connection.close()
+    if hasattr(cache, 'close'):
+        cache.close()
+
+
+def warm_rows(model, chunk, pause=0, first=None, last=None):
+    '''Занести в кеш строки модели с pk в (first, last] пачками по chunk строк
+    в порядке pk. Отдает количество занесенных строк после каждой пачки.
+    '''
+    queryset = model._default_manager.get_query_set()
+    rows = queryset.order_by('pk')
+    if last is not None:
+        rows = rows.filter(pk__lte=last)
+    while True:
+        start = time()
+        objs = list((rows if first is None else rows.filter(pk__gt=first))[:chunk].iterator())
+        reset_queries()
+        if not objs:
+            break
+        queryset.insert_many_to_cache(objs, (time() - start) / len(objs))
+        first = objs[-1].pk
+        yield len(objs)
+        if pause:
+            sleep(pause)
+
+
+def _warm_range(args):
+    label, chunk, pause, first, last = args
+    return sum(warm_rows(get_model(*label.split('.')), chunk, pause, first, last))
+
+
+def prefixes(model, field_name, chunk, length):
+    '''Все различные префиксы длиной до length значений поля автокомплита
+    '''
+    field, _filter = field_name.split('__')
+    result = set()
+    values = model._default_manager.order_by('pk').values_list('pk', field)
+    first = None
+    while True:
+        rows = list((values if first is None else values.filter(pk__gt=first))[:chunk])
+        reset_queries()
+        if not rows:
+            break
+        for pk, value in rows:
+            if not value:
+                continue
+            value = unicode(value)
+            if _filter == 'istartswith':
+                value = value.lower()
+            result.update(continuate_string_iterator(value, length))
+        first = rows[-1][0]
+    return sorted(result)
+
+
+class Command(BaseCommand):
+    help = u'Заполняет кеш объектами CachedModel (по всем cached_attrs) и, с --autocomplete, ' \
+           u'префиксами автокомплита. Без аргументов прогревает все такие модели.'
+    args = '[app.Model app.Model ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk', dest='chunk', type='int', default=1000,
+            help=u'Сколько строк читать из базы за один запрос'),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+            help=u'Пауза в секундах после каждой пачки, чтобы не нагружать базу'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help=u'Количество процессов; диапазон pk делится между ними'),
+        make_option('--autocomplete', action='store_true', dest='autocomplete', default=False,
+            help=u'Прогреть еще и префиксы AutocompleteManager, таблицы FTS5 и таблицы строк. '
+                 u'Индекс autocomplete_backend = \'index\' каждый процесс строит сам при первом поиске'),
+        make_option('--prefix-length', dest='prefix_length', type='int', default=2,
+            help=u'Префиксы какой длины прогревать для автокомплита'),
+    )
+
+    def handle(self, *labels, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Expected app.Model, got %s' % label)
+                model = get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError('Unknown model %s' % label)
+                models.append(model)
+        else:
+            models = [model for model in get_models() if self._is_cached(model) or
+                      (options['autocomplete'] and self._is_autocomplete(model))]
+
+        for model in models:
+            label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+            if self._is_cached(model):
+                self._warm_model(label, model, options)
+            elif not options['autocomplete']:
+                raise CommandError('%s is not a CachedModel' % label)
+            if options['autocomplete']:
+                if self._is_autocomplete(model):
+                    self._warm_autocomplete(label, model, options)
+                elif labels:
+                    raise CommandError('%s is not an AutocompleteModel' % label)
+
+    def _is_cached(self, model):
+        return isinstance(model._default_manager.get_query_set(), CachedQuerySet)
+
+    def _is_autocomplete(self, model):
+        return isinstance(getattr(model, 'autocomplete', None), AutocompleteManager)
+
+    def _progress(self, label, done, start):
+        if self.verbosity:
+            sys.stdout.write('\r%s: %s rows, %.0f rows/s' % (label, done, done / max(time() - start, 1e-6)))
+            sys.stdout.flush()
+
+    def _warm_model(self, label, model, options):
+        start, done = time(), 0
+        workers = options['workers']
+        if workers > 1:
+            bounds = model._default_manager.aggregate(first=Min('pk'), last=Max('pk'))
+            if bounds['first'] is not None:
+                # диапазоны поменьше, чтобы процессы заканчивали примерно одновременно
+                parts = workers * 4
+                step = max((bounds['last'] - bounds['first'] + 1) / parts, 1)
+                tasks = [(label, options['chunk'], options['sleep'], first, first + step)
+                         for first in xrange(bounds['first'] - 1, bounds['last'], step)]
+                _close_connections()
+                pool = Pool(workers, _close_connections)
+                try:
+                    for count in pool.imap_unordered(_warm_range, tasks):
+                        done += count
+                        self._progress(label, done, start)
+                finally:
+                    pool.close()
+                    pool.join()
+        else:
+            for count in warm_rows(model, options['chunk'], options['sleep']):
+                done += count
+                self._progress(label, done, start)
+        if self.verbosity:
+            sys.stdout.write('\r%s: %s rows warmed in %.1f s\n' % (label, done, time() - start))
+
+    def _warm_autocomplete(self, label, model, options):
+        manager = model.autocomplete
+        start, done = time(), 0
+        # общие для всех процессов таблицы FTS5 и таблицы строк строятся целиком, а индекс
+        # в памяти (autocomplete_backend = 'index') есть только у этого процесса и не прогревается
+        for field_name in manager._fields('fts'):
+            manager._fill_fts_index(field_name, manager.get_fts_index(field_name))
+        for field_name in manager._fields('sstable'):
+            manager.build_sstable(field_name)
+        for field_name in manager._fields('cache'):
+            for q in prefixes(model, field_name, options['chunk'], options['prefix_length']):
+                manager.find(field_name, q)
+                reset_queries()
+                done += 1
+                if self.verbosity:
+                    sys.stdout.write('\r%s autocomplete: %s prefixes' % (label, done))
+                    sys.stdout.flush()
+                if options['sleep']:
+                    sleep(options['sleep'])
+        if self.verbosity:
+            sys.stdout.write('\r%s autocomplete: %s prefixes warmed in %.1f s\n' % (label, done, time() - start))
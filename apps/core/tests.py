@@ -0,0 +1,91 @@
+#coding=utf-8
+import unittest
+
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+
+from libs.cache import CachedModel, get_version
+
+
+class CacheAuthor(CachedModel):
+    name = models.CharField(max_length=100)
+    cached_attrs = ['name']
+
+    class Meta:
+        app_label = 'core'
+        db_table = 'core_test_cache_author'
+
+
+class CacheBook(CachedModel):
+    title = models.CharField(max_length=100)
+    author = models.ForeignKey(CacheAuthor)
+
+    class Meta:
+        app_label = 'core'
+        db_table = 'core_test_cache_book'
+
+
+class CachedModelTest(unittest.TestCase):
+    '''Кеш CachedQuerySet не должен отдавать удаленные и измененные строки
+    '''
+    models = (CacheAuthor, CacheBook)
+
+    def setUp(self):
+        style = no_style()
+        cursor = connection.cursor()
+        for model in self.models:
+            sql, references = connection.creation.sql_create_model(model, style, set())
+            for statement in sql:
+                cursor.execute(statement)
+            # в общем кеше могли остаться записи прошлого запуска с теми же pk
+            model.objects.invalidate_model()
+        transaction.commit_unless_managed()
+
+    def tearDown(self):
+        cursor = connection.cursor()
+        for model in reversed(self.models):
+            for sql in connection.creation.sql_destroy_model(model, {}, no_style()):
+                cursor.execute(sql)
+        transaction.commit_unless_managed()
+
+    def create_book(self, author_name='Author', title='Book'):
+        author = CacheAuthor.objects.create(name=author_name)
+        book = CacheBook.objects.create(title=title, author=author)
+        # заносим в кеш
+        CacheBook.objects.get(id=book.id)
+        CacheAuthor.objects.get(name=author_name)
+        return author, book
+
+    def assertDeleted(self, model, **kwargs):
+        self.assertRaises(model.DoesNotExist, model.objects.get, **kwargs)
+
+    def test_delete(self):
+        author, book = self.create_book()
+        book.delete()
+        self.assertDeleted(CacheBook, id=book.id)
+
+    def test_cascade_delete(self):
+        author, book = self.create_book()
+        author.delete()
+        self.assertDeleted(CacheAuthor, name='Author')
+        self.assertDeleted(CacheBook, id=book.id)
+
+    def test_queryset_delete(self):
+        author, book = self.create_book()
+        CacheAuthor.objects.filter(name='Author').delete()
+        self.assertDeleted(CacheAuthor, id=author.id)
+        self.assertDeleted(CacheBook, id=book.id)
+
+    def test_update(self):
+        author, book = self.create_book()
+        other_author, other_book = self.create_book('Other', 'Other book')
+        # метка Tombstone по будущему значению
+        self.assertDeleted(CacheAuthor, name='New')
+        version = get_version(CacheAuthor).get()
+        CacheAuthor.objects.filter(pk=author.pk).update(name='New')
+        self.assertEqual(CacheAuthor.objects.get(name='New').pk, author.pk)
+        self.assertDeleted(CacheAuthor, name='Author')
+        # остальные строки остаются в кеше
+        self.assertEqual(get_version(CacheAuthor).get(), version)
+        CacheBook.objects.update(title='Same')
+        self.assertEqual(CacheBook.objects.get(id=other_book.id).title, 'Same')
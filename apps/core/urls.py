@@ -8,6 +8,8 @@ admin.autodiscover()
 urlpatterns = patterns('apps.core.views',
         url(r'^$', 'index', name="index"),
         url(r'^login/$', 'login', {'template_name': 'registration/login.haml'}, name="login"),
+        url(r'^autocomplete/(?P<app_label>\w+)\.(?P<model_name>\w+)/(?P<field_name>\w+)/$', 'autocomplete',
+            name="autocomplete"),
  )
 
 urlpatterns += patterns('',
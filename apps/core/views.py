@@ -1,6 +1,35 @@
+#coding=utf-8
+from django.db.models import get_model
+
 from apps.core.django_auth import login
-from libs.decorators import render_to
+from libs.autocomplete import AutocompleteManager
+from libs.decorators import render_to, ajax_request, cache_response
 
 @render_to("index.haml")
 def index(request):
-    return {}
\ No newline at end of file
+    return {}
+
+
+@cache_response(max_age=60)
+@ajax_request
+def autocomplete(request, app_label, model_name, field_name):
+    """Подсказки AutocompleteManager.find для модели с autocomplete_public = True.
+
+    GET-параметры: q - введенный текст, limit - сколько подсказок вернуть (необязательно).
+    В ответе r - подсказки, c - 1, если это все подходящие значения (тогда клиент может
+    сам отфильтровать их для более длинного q), m - как сравнивается q (лукап поля).
+    """
+    model = get_model(app_label, model_name)
+    if model is None or not getattr(model, 'autocomplete_public', False) or \
+            not isinstance(getattr(model, 'autocomplete', None), AutocompleteManager):
+        raise ValueError('Autocomplete is not available for %s.%s' % (app_label, model_name))
+    manager = model.autocomplete
+    field_name = manager._normalize_attr(field_name)
+    if field_name not in manager._fields():
+        raise ValueError('%s is not an autocomplete field of %s.%s' % (field_name, app_label, model_name))
+    q = request.GET.get('q', '')
+    max_limit = getattr(model, 'autocomplete_limit', 150)
+    # отрицательный limit срезал бы хвост списка подсказок
+    limit = min(max(int(request.GET.get('limit', 0)) or max_limit, 1), max_limit)
+    result = manager.find(field_name, q, limit) if q.strip() else []
+    return {'r': result, 'c': int(len(result) < limit), 'm': field_name.split('__')[1]}
@@ -3,6 +3,9 @@
 DEBUG = False
 TEMPLATE_DEBUG = DEBUG
 
+CONTRACTS_SAMPLE_RATE = 100
+CONTRACTS_CONTAINER_SAMPLE = 20
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
@@ -1,18 +1,35 @@
 #coding=utf-8
 #--- Author: Dmitri Patrakov <traditio@gmail.com>
 import logging
+import os
+import threading
+from bisect import bisect_left
+from time import time, sleep
 log = logging.getLogger(__name__)
 
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Max
 from django.core.cache import cache
 
-from libs.shared.contracts import takes, optional, returns, list_of
+from libs.contracts import takes, optional, returns, list_of
+from libs.cache import get_or_compute, stats, Generation, STALE_TIMEOUT
+from libs.prefix_index import PrefixIndex
+from libs.ngram_index import WordIndex, FTSIndex
+from libs.sstable import SSTable, write_table
+
+PREFIX_LOOKUPS = ('startswith', 'istartswith')
+WORD_LOOKUPS = ('words', 'icontains') # по началу любого слова / по подстроке
+
+JOURNAL_SIZE = 1000 # при отставании больше чем на столько изменений индекс строится заново
+JOURNAL_TIMEOUT = 60 * 60
+JOURNAL_WAIT = 0.05 # сколько секунд ждать записей журнала, номера которых уже выданы
 
 
 def check_field_name_for_autocomplete(field_name):
 	if len(field_name.split('__'))>1:
 		filter = field_name.split('__')[1]
-		if not(filter=='startswith' or filter=='istartswith'):
+		if filter not in PREFIX_LOOKUPS + WORD_LOOKUPS:
 			log.error('field_name')
 			return False
 			
@@ -32,6 +49,150 @@ def continuate_string_iterator(s, lim=None):
 		yield s[:i]
 
 
+class AutocompleteIndex(object):
+	'''Префиксные индексы (PrefixIndex) полей автокомплита модели в памяти процесса.
+
+	Индекс строится из базы при первом запросе. Изменения объектов записываются
+	в журнал в общем кеше: счетчик изменений (Generation) и запись (pk, {поле: значение}, вес)
+	под ключом с номером изменения. Перед поиском процесс, не чаще чем раз в
+	check_interval секунд, дочитывает из журнала новые записи и применяет их к индексу.
+	publish_many() увеличивает счетчик раньше, чем пишет записи, поэтому недостающие записи
+	перечитываются еще раз через JOURNAL_WAIT секунд. Если их все равно не хватает (вытеснены
+	или процесс отстал больше чем на JOURNAL_SIZE), индекс строится заново: из базы его
+	читает один поток без блокировки индекса, а остальные пока ищут по старому индексу.
+	'''
+	def __init__(self, model, fields, check_interval=1, score_field=None, top_size=10):
+		self.model = model
+		self.fields = fields
+		self.score_field = score_field
+		self.top_size = top_size
+		self.prefix = '%s.%s.autocomplete' % (model.__module__, model.__name__)
+		self.seq = Generation('%s.seq' % self.prefix, check_interval)
+		self.lock = threading.RLock()
+		self.building = threading.Lock()
+		self.indexes = None
+		self.applied = None
+
+	def _journal_key(self, seq):
+		return '%s.journal.%s' % (self.prefix, seq)
+
+	def find(self, field_name, q, limit=None):
+		self.refresh()
+		return self.indexes[field_name].find(q, limit)
+
+	def refresh(self):
+		seq = self.seq.get()
+		applied = self.applied
+		if self.indexes is not None and seq == applied:
+			return
+		if self.indexes is None or not 0 <= seq - applied <= JOURNAL_SIZE:
+			return self._rebuild(seq)
+		entries = self._read_journal(applied + 1, seq)
+		if entries is None:
+			return self._rebuild(seq)
+		with self.lock:
+			if self.applied < applied:
+				# индекс построен заново по более раннему номеру, его дочитает следующий refresh()
+				return
+			# пока читали журнал, часть записей мог применить другой поток
+			for i in xrange(self.applied + 1, seq + 1):
+				self._apply(*entries[i - applied - 1])
+				self.applied = i
+
+	def _read_journal(self, first, last):
+		'''Записи журнала с номерами от first до last или None, если какой-то не хватает
+		или среди них есть требование построить индекс заново
+		'''
+		keys = [self._journal_key(i) for i in xrange(first, last + 1)]
+		entries = cache.get_many(keys)
+		if len(entries) < len(keys):
+			sleep(JOURNAL_WAIT)
+			entries.update(cache.get_many([key for key in keys if key not in entries]))
+			if len(entries) < len(keys):
+				return None
+		entries = [entries[key] for key in keys]
+		if any(pk is None for pk, values, score in entries):
+			return None
+		return entries
+
+	def _rebuild(self, seq):
+		if self.building.acquire(False):
+			try:
+				self.rebuild(seq)
+			finally:
+				self.building.release()
+		elif self.indexes is None:
+			# индекс строит другой поток, а искать пока не в чем
+			with self.building:
+				pass
+
+	def rebuild(self, seq=None):
+		'''Построить индексы из базы. seq - номер изменения, которое уже видно в базе:
+		записи журнала после него применяются при следующем refresh()
+		'''
+		if seq is None:
+			seq = self.seq.get()
+		start = time()
+		names = [field.split('__')[0] for field in self.fields]
+		columns = [[] for field in self.fields]
+		for row in self.model._default_manager.values_list('pk', self.score_field or 'pk', *names).iterator():
+			score = row[1] if self.score_field else 0
+			for i, value in enumerate(row[2:]):
+				if value:
+					columns[i].append((row[0], unicode(value), score))
+		with self.lock:
+			self.indexes = dict((field, self._create_index(field, items))
+					for field, items in zip(self.fields, columns))
+			self.applied = seq
+		stats.timing('%s.%s' % (self.model._meta.app_label, self.model._meta.object_name),
+				'index_rebuild', time() - start)
+
+	def _create_index(self, field, items):
+		lookup = field.split('__')[1]
+		if lookup in WORD_LOOKUPS:
+			return WordIndex(items, infix=lookup == 'icontains')
+		return PrefixIndex(items, lookup == 'startswith', ranked=bool(self.score_field), top_size=self.top_size)
+
+	def _apply(self, pk, values, score):
+		for field, index in self.indexes.iteritems():
+			if values is None:
+				index.remove(pk)
+			elif field in values:
+				index.add(pk, values[field], score or 0)
+			elif score is not None:
+				index.set_score(pk, score)
+
+	def publish(self, pk, values, score=None):
+		'''Записать изменение объекта pk в журнал. values - словарь {поле: значение}
+		(поля, которых в нем нет, не меняются), None - объект удален; score - новый вес
+		объекта; pk=None - индекс надо построить заново
+		'''
+		self.publish_many([(pk, values, score)])
+
+	def publish_many(self, entries):
+		'''Записать в журнал несколько изменений (pk, values, score) одним set_many
+		'''
+		if not entries:
+			return
+		seq = self.seq.incr(len(entries))
+		first = seq - len(entries) + 1
+		cache.set_many(dict((self._journal_key(first + i), entry) for i, entry in enumerate(entries)),
+				JOURNAL_TIMEOUT)
+		with self.lock:
+			# свои изменения видны сразу, чужие - после refresh()
+			if self.indexes is not None and first == self.applied + 1:
+				for i, (pk, values, score) in enumerate(entries):
+					if pk is None:
+						break
+					self._apply(pk, values, score)
+					self.applied = first + i
+
+
+_indexes = {}
+_fts_indexes = {}
+_sstables = {}
+
+
 class AutocompleteManager(models.Manager):	
 	'''Менеджер для моделей с автокомплитом.
 	Хранит в кеше сразу массив строк, который возвращается по запросу
@@ -41,6 +202,33 @@ class AutocompleteManager(models.Manager):
 	
 	Опционально можете создать аттрибут autocomplete_limit который говорит о том, сколько строковых значений хранить в 
 	кеше для каждого поля моделя.	
+
+	С autocomplete_backend = 'index' значения ищутся не в кеше по ключу на каждый префикс,
+	а в отсортированном индексе в памяти процесса (см. AutocompleteIndex), и save() не
+	удаляет ключи из кеша, а пишет одну запись в журнал изменений. Как часто процессы
+	проверяют журнал, задает autocomplete_check_interval (в секундах, по умолчанию 1).
+
+	Если указан аттрибут autocomplete_score_field (числовое поле модели, например население
+	города), то find возвращает значения по убыванию этого поля. Поле может быть и счетчиком
+	выбора подсказки, который увеличивает record_selection(obj). В режиме кеша порядок
+	закешированных списков обновляется только после их истечения, а индекс видит новый вес сразу.
+
+	Поля вида FIELD_NAME__words ищутся по началу любого слова значения (u'Петр' находит
+	u'Иванов Петр', u'ив пе' - тоже), а FIELD_NAME__icontains - еще и по подстроке от трех
+	символов. Такие поля всегда ищутся в индексе: в памяти процесса (WordIndex, обновляется
+	через тот же журнал) или, с autocomplete_word_backend = 'fts', в таблице SQLite FTS5
+	в файле из каталога настройки AUTOCOMPLETE_FTS_DIR, общем для всех процессов
+	(без настройки - как autocomplete_word_backend = 'memory', своя таблица в памяти каждого
+	процесса не видела бы чужих изменений). Ранжирование для них не поддерживается.
+
+	С autocomplete_backend = 'sstable' значения ищутся в неизменяемых отсортированных
+	таблицах (см. libs.sstable) в каталоге AUTOCOMPLETE_SSTABLE_DIR, которые все процессы
+	открывают через mmap и делят одну копию в памяти. Таблицы пишет manage.py
+	build_autocomplete_tables (например по cron), сохранение объектов их не меняет,
+	поэтому изменения видны после следующей сборки. Ранжирование для них не поддерживается.
+
+	С autocomplete_public = True подсказки модели отдает по HTTP представление
+	apps.core.views.autocomplete (клиент - static/coffee/autocomplete.coffee).
 	'''
 	@takes("AutocompleteManager", basestring)
 	def _normalize_attr(self, attr):
@@ -52,19 +240,234 @@ class AutocompleteManager(models.Manager):
 			value = value.lower()
 		return '%s.%s.%s.%s' % (self.model.__module__, self.model.__name__, attr, value)
 
+	def _engine(self, field):
+		'''Где ищутся значения поля: 'cache', 'index' (AutocompleteIndex) или 'fts'
+		'''
+		if field.split('__')[1] in WORD_LOOKUPS:
+			fts = getattr(self.model, 'autocomplete_word_backend', 'memory') == 'fts' and \
+					getattr(settings, 'AUTOCOMPLETE_FTS_DIR', None)
+			return 'fts' if fts else 'index'
+		backend = getattr(self.model, 'autocomplete_backend', 'cache')
+		return backend if backend in ('index', 'sstable') else 'cache'
+
+	def _fields(self, engine=None):
+		fields = [self._normalize_attr(attr) for attr in getattr(self.model, 'autocomplete_fields')]
+		return [field for field in fields if engine is None or self._engine(field) == engine]
+
+	def get_index(self):
+		'''Индекс автокомплита модели в этом процессе
+		'''
+		try:
+			return _indexes[self.model]
+		except KeyError:
+			fields = self._fields('index')
+			index = _indexes[self.model] = AutocompleteIndex(self.model, fields,
+					getattr(self.model, 'autocomplete_check_interval', 1),
+					getattr(self.model, 'autocomplete_score_field', None),
+					getattr(self.model, 'autocomplete_limit', 150))
+			return index
+
+	def get_fts_index(self, field):
+		'''Таблица FTS5 поля, при первом обращении к пустой таблице она заполняется из базы
+		'''
+		try:
+			return _fts_indexes[(self.model, field)]
+		except KeyError:
+			directory = settings.AUTOCOMPLETE_FTS_DIR
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			path = os.path.join(directory, '%s.%s.sqlite' % (self.model._meta.app_label,
+					self.model._meta.object_name))
+			index = FTSIndex(path, field, infix=field.endswith('__icontains'))
+			if not len(index):
+				self._fill_fts_index(field, index)
+			_fts_indexes[(self.model, field)] = index
+			return index
+
+	def _fill_fts_index(self, field, index):
+		name = field.split('__')[0]
+		index.clear()
+		index.add_many((pk, unicode(value)) for pk, value in
+				self.get_query_set().values_list('pk', name).iterator() if value)
+
+	def sstable_path(self, field):
+		return os.path.join(settings.AUTOCOMPLETE_SSTABLE_DIR, '%s.%s.%s.sst' % (
+				self.model._meta.app_label, self.model._meta.object_name, field))
+
+	def build_sstable(self, field):
+		'''Записать таблицу значений поля из базы. Процессы, которые ее уже открыли,
+		перейдут на новую таблицу в течение autocomplete_check_interval секунд
+		'''
+		name = field.split('__')[0]
+		path = self.sstable_path(field)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		values = self.get_query_set().order_by().values_list(name, flat=True).distinct().iterator()
+		write_table(path, (unicode(value) for value in values if value),
+				case_sensitive=field.endswith('__startswith'))
+		return path
+
+	def get_sstable(self, field):
+		'''Таблица поля в этом процессе, если файла еще нет - она строится
+		'''
+		try:
+			return _sstables[(self.model, field)]
+		except KeyError:
+			path = self.sstable_path(field)
+			if not os.path.exists(path):
+				self.build_sstable(field)
+			table = _sstables[(self.model, field)] = SSTable(path,
+					getattr(self.model, 'autocomplete_check_interval', 1))
+			return table
+
+	def rebuild(self):
+		'''Построить заново индексы, таблицы FTS5 и таблицы строк модели из базы
+		'''
+		if self._fields('index'):
+			self.get_index().rebuild()
+		for field in self._fields('fts'):
+			self._fill_fts_index(field, self.get_fts_index(field))
+		for field in self._fields('sstable'):
+			self.build_sstable(field)
+
+	def snapshot(self, obj):
+		'''Значения полей автокомплита объекта {поле: значение} и, если есть, его вес.
+		AutocompleteModel запоминает их при загрузке и после сохранения, что бы
+		update() знал старые значения.
+		'''
+		result = {}
+		for field in getattr(self.model, 'autocomplete_fields'):
+			value = getattr(obj, field.split('__')[0])
+			result[self._normalize_attr(field)] = value and unicode(value)
+		score_field = getattr(self.model, 'autocomplete_score_field', None)
+		if score_field:
+			result[score_field] = getattr(obj, score_field)
+		return result
+
 	@takes("AutocompleteManager", models.Model)
 	def update(self, obj):
-		'''Очистить кеш для данного объекта
-		'''
-		assert self.model
-		autocomplete_fields = [self._normalize_attr(attr) for attr in getattr(self.model, 'autocomplete_fields')]
-		assert autocomplete_fields 
-		for field in autocomplete_fields:
-			val = getattr(obj, field.split('__')[0])
-			assert val, '{0} has no attr {1}'.format(obj.__class__, val)
-			for value in continuate_string_iterator(val):
-				key = self._gen_cache_key(field, value)
-				cache.delete(key)
+		'''Внести в автокомплит изменения сохраненного объекта
+		'''
+		self.update_many([obj])
+
+	def update_many(self, objs):
+		'''Внести в автокомплит изменения нескольких сохраненных объектов разом,
+		например после импорта. Старые значения берутся из снимка, который
+		объект сделал при загрузке (см. snapshot), новые - из самого объекта.
+		'''
+		changes = []
+		for obj in objs:
+			new = self.snapshot(obj)
+			changes.append((obj.pk, getattr(obj, '_autocomplete_loaded', {}), new))
+			obj._autocomplete_loaded = new
+		self._apply_changes(changes)
+
+	@takes("AutocompleteManager", models.Model, optional(object))
+	def remove(self, obj, pk=None):
+		'''Убрать из автокомплита удаленный объект. pk - ключ объекта до удаления
+		'''
+		self._apply_changes([(pk or obj.pk, getattr(obj, '_autocomplete_loaded', None) or self.snapshot(obj), None)])
+
+	def _apply_changes(self, changes):
+		'''changes - список (pk, старые значения, новые значения или None для удаленного объекта)
+		'''
+		score_field = getattr(self.model, 'autocomplete_score_field', None)
+		fields = self._fields('index')
+		if fields:
+			entries = []
+			for pk, old, new in changes:
+				if new is None:
+					entries.append((pk, None, None))
+					continue
+				values = dict((field, new[field]) for field in fields if field not in old or old[field] != new[field])
+				score = score_field and new[score_field]
+				if values or (score_field and old.get(score_field) != score):
+					entries.append((pk, values, score))
+			self.get_index().publish_many(entries)
+
+		for field in self._fields('fts'):
+			# одной транзакцией: значение None удаляет объект из таблицы
+			self.get_fts_index(field).add_many([(pk, new and new[field]) for pk, old, new in changes
+					if new is None or old.get(field) != new[field]])
+
+		fields = self._fields('cache')
+		if not fields:
+			return
+
+		# в кеше лежат списки различных значений по каждому префиксу: старое значение
+		# убирается из них, если его больше нет ни у одного объекта, а новое вставляется
+		limit = getattr(self.model, 'autocomplete_limit', 150)
+		keys_to_delete, removed, added = set(), {}, {}
+		for pk, old, new in changes:
+			for field in fields:
+				old_value, new_value = old.get(field), new and new[field]
+				if old_value == new_value:
+					if new_value and score_field and old.get(score_field) != new[score_field]:
+						# вес изменился - порядок в списках известен только базе
+						keys_to_delete.update(self._prefix_keys(field, new_value))
+					continue
+				if old_value:
+					removed.setdefault(field, set()).add(old_value)
+				if new_value:
+					added.setdefault(field, set()).add(new_value)
+		for field, values in removed.items():
+			name = field.split('__')[0]
+			values -= set(unicode(value) for value in self.get_query_set()
+					.filter(**{'%s__in' % name: list(values)}).values_list(name, flat=True).distinct())
+		keys = {}
+		for changed, action in ((removed, 'remove'), (added, 'add')):
+			for field, values in changed.iteritems():
+				for value in values:
+					for key in self._prefix_keys(field, value):
+						keys.setdefault(key, []).append((action, value))
+		entries = cache.get_many([key for key in keys if key not in keys_to_delete])
+		for key, entry in entries.items():
+			result = entry[0]
+			for action, value in keys[key]:
+				if action == 'remove' and value in result:
+					if len(result) >= limit:
+						# за пределами списка могут быть значения, которых мы не знаем
+						keys_to_delete.add(key)
+						break
+					result.remove(value)
+				elif action == 'add' and value not in result:
+					if score_field:
+						keys_to_delete.add(key)
+						break
+					i = bisect_left(result, value)
+					if i < limit:
+						result.insert(i, value)
+						del result[limit:]
+			if key in keys_to_delete:
+				del entries[key]
+		cache.delete_many(list(keys_to_delete))
+		# время истечения в записи остается прежним
+		cache.set_many(entries, cache.default_timeout + STALE_TIMEOUT)
+
+	def _prefix_keys(self, field, value):
+		return set(self._gen_cache_key(field, prefix) for prefix in continuate_string_iterator(value))
+
+	@takes("AutocompleteManager", models.Model)
+	def record_selection(self, obj):
+		'''Пользователь выбрал подсказку объекта obj: увеличить его вес autocomplete_score_field
+		'''
+		score_field = getattr(self.model, 'autocomplete_score_field')
+		queryset = self.get_query_set().filter(pk=obj.pk)
+		queryset.update(**{score_field: F(score_field) + 1})
+		score = queryset.values_list(score_field, flat=True)[0]
+		setattr(obj, score_field, score)
+		if hasattr(obj, '_autocomplete_loaded'):
+			obj._autocomplete_loaded[score_field] = score
+		if self._fields('index'):
+			self.get_index().publish(obj.pk, {}, score)
+
+	def invalidate(self):
+		'''Построить индекс заново во всех процессах, например после queryset.update()
+		'''
+		if self._fields('index'):
+			self.get_index().publish(None, None)
+		for field in self._fields('fts'):
+			self._fill_fts_index(field, self.get_fts_index(field))
 
 	@takes("AutocompleteManager",
 		   (basestring, check_field_name_for_autocomplete),
@@ -77,7 +480,8 @@ class AutocompleteManager(models.Manager):
 		для поля field_name
 
 		Args:	
-			field_name - строка FIELD_NAME (регистрозависимое) или FIELD_NAME__istartswith - регистронезависимая)
+			field_name - строка FIELD_NAME (регистрозависимое) или FIELD_NAME__istartswith - регистронезависимая),
+				FIELD_NAME__words или FIELD_NAME__icontains (см. описание класса)
 			q - одна или несколько первых букв, с которых должно начинаться слово для автокомплита 
 		'''
 		autocomplete_fields = getattr(self.model, 'autocomplete_fields')
@@ -89,37 +493,51 @@ class AutocompleteManager(models.Manager):
 		# если вообще limit не указан, то берем из настроек модели
 		if not limit:
 			limit = autocomplete_limit
+		assert field_name in autocomplete_fields
+		stats.incr(self._stats_name(field_name), 'find')
+		engine = self._engine(field_name)
+		if engine == 'index':
+			stats.incr(self._stats_name(field_name), 'local_hit')
+			return self.get_index().find(field_name, q, limit)
+		if engine == 'fts':
+			stats.incr(self._stats_name(field_name), 'local_hit')
+			return self.get_fts_index(field_name).find(q, limit)
+		if engine == 'sstable':
+			stats.incr(self._stats_name(field_name), 'local_hit')
+			return self.get_sstable(field_name).find(q, limit)
 		# строим ключ для field_name и q (query search)
 		key = self._gen_cache_key(field_name, q)
-		# ищем в кеше
-		cached_result = cache.get(key)
-		# если найдено, возвращаем массив строк с указанным лимитом
-		if cached_result:
-			log.debug('Get from cache key %s', key)
-			return cached_result[:limit]
-		# иначе
+		# ищем в кеше, при промахе в базу идет только один запрос, остальные ждут его результата
+		result = get_or_compute(key, lambda: self._find_in_db(field_name, q, autocomplete_limit),
+				stats_name=self._stats_name(field_name))
+		# возвращаем массив строк с указанным лимитом
+		return result[:limit]
+
+	def _stats_name(self, field_name):
+		return '%s.%s.%s' % (self.model._meta.app_label, self.model._meta.object_name, field_name)
+
+	def _find_in_db(self, field_name, q, limit):
+		'''Различные значения поля, которые начинаются с q, по порядку, не больше limit.
+		Из базы берется только этот столбец; кеш других полей заполняется при их собственных промахах.
+		'''
+		log.debug('Not found in cache, query database for %s=%s', field_name, q)
+		stats.incr(self._stats_name(field_name), 'miss')
+		start = time()
+		field = field_name.split('__')[0]
+		queryset = self.get_query_set().filter(**{field_name: q})
+		score_field = getattr(self.model, 'autocomplete_score_field', None)
+		if score_field:
+			# у одинаковых значений берется наибольший вес
+			queryset = queryset.values(field).annotate(autocomplete_score=Max(score_field)) \
+					.order_by('-autocomplete_score', field)
+			result = [unicode(row[field]) for row in queryset[:limit]]
 		else:
-			# если field_name кончается на iexact то запрос будет field_name__istartswith
-			# иначе запрос будет field_name___startswith
-			query_filter = field_name.replace('exact', 'startswith')
-			# делаем запрос в базу с указанным в настройках модели лимитом
-			db_result = self.get_query_set().filter(**{query_filter: q}).all()
-			assert field_name in autocomplete_fields
-			result = []
-			# проходимся по каждому autocomplete_fields
-			for field in autocomplete_fields:				
-				# заносим в кеш
-				cached_result = [unicode(getattr(obj, field.split('__')[0])) for obj in db_result]				
-				if cached_result:
-					key = self._gen_cache_key(field, q)
-					cache.set(key, cached_result)	
-					log.debug('Set to cache key %s', key)
-				# если оно наше (то есть запрошенное, то записываем как результат)
-				if field==field_name:
-					result=cached_result
-			assert result
-			# возвращаем массив строк с указанным лимитом
-			return result[:limit]
+			result = [unicode(value) for value in queryset
+					.order_by(field)
+					.values_list(field, flat=True)
+					.distinct()[:limit]]
+		stats.timing(self._stats_name(field_name), 'db', time() - start)
+		return result
 
 		
 class AutocompleteModel(models.Model):
@@ -129,13 +547,20 @@ class AutocompleteModel(models.Model):
 	autocomplete = AutocompleteManager()
 	autocomplete_limit = 150
 
+	def __init__(self, *args, **kwargs):
+		super(AutocompleteModel, self).__init__(*args, **kwargs)
+		# значения при загрузке, что бы save() убрал из автокомплита именно их;
+		# из строки базы объект создается с позиционными аргументами, новый - обычно с именованными
+		self._autocomplete_loaded = self.__class__.autocomplete.snapshot(self) if args else {}
+
 	def save(self, force_insert=False, force_update=False, using=None):
 		super(AutocompleteModel, self).save(force_insert, force_update, using)
 		self.__class__.autocomplete.update(self)
 
 	def delete(self, using=None):
-		self.__class__.autocomplete.update(self)
-		super(AutocompleteModel, self).autocomplete.update(self)
+		pk = self.pk
+		super(AutocompleteModel, self).delete(using)
+		self.__class__.autocomplete.remove(self, pk)
 
 	class Meta:
 		abstract = True
\ No newline at end of file
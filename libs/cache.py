@@ -1,27 +1,403 @@
 #coding=utf8
 
 import logging
+import operator
+import threading
+from copy import copy
+from math import log as ln
+from random import random
+from time import time, sleep
+from collections import OrderedDict
 from django.db import models
+from django.db.models import Q
+from django.db.models.expressions import ExpressionNode
 from django.core.cache import cache
+from django.core.cache.backends.base import BaseCache
+
+from libs.stats import Stats
 
 log = logging.getLogger(__name__)
 
+# статистика кеша: CachedQuerySet по 'app.Model.attr', AutocompleteManager по 'app.Model.field'
+# и cached_property по 'module.function' (см. manage.py cache_stats)
+stats = Stats('cache')
+
+# защита от одновременного пересчета (cache stampede)
+LOCK_TIMEOUT = 5 # сколько секунд живет блокировка на пересчет ключа
+LOCK_WAIT = 0.5 # сколько секунд ждать значения, которое пересчитывает другой процесс
+LOCK_POLL_INTERVAL = 0.05
+STALE_TIMEOUT = 60 # сколько секунд после истечения еще можно отдавать устаревшее значение
+EARLY_REFRESH_BETA = 1.0 # чем больше, тем раньше пересчитываются значения; 0 - не пересчитывать заранее
+
+PREFETCH_CHUNK_SIZE = 100 # по сколько объектов подгружать связанные объекты в prefetch_cached
+UPDATE_ROWS_LIMIT = 100 # update() большего числа строк сбрасывает весь кеш модели
+
+# сколько секунд живут счетчики версий и поколений (см. Generation); с таймаутом кеша
+# по умолчанию они истекали бы одновременно во всех процессах, сбрасывая весь кеш модели
+COUNTER_TIMEOUT = 365 * 24 * 3600
+
 
-def cached_property(f):
-	"""Кешированный property для класса
+class cached_property(object):
+	"""Кешированный property для класса.
+
+	Значение вычисляется один раз на объект и хранится в его __dict__.
+	del obj.prop или invalidate_cached_properties(obj) сбрасывают его.
+	Значение вычисляется без блокировок (вложенные cached_property разных объектов
+	в разных потоках иначе могут взаимно заблокироваться) и сохраняется через
+	setdefault, поэтому под многопоточным сервером все потоки получают одно и то же
+	значение, даже если его одновременно посчитали несколько из них.
+
+	@cached_property(shared=True, timeout=600) дополнительно хранит значение в общем кеше,
+	так что его видят следующие запросы и другие процессы. Ключ строится по модели, pk
+	и версии строки (см. cache_row_versions в CachedQuerySet - для моделей с такими
+	свойствами версии строк включаются сами), поэтому после save() объекта значение
+	пересчитывается. У моделей, которые не наследуют CachedModel, версии строки нет
+	и значение живет до истечения timeout.
 	"""
-	def get(self):
+	def __init__(self, f=None, shared=False, timeout=None):
+		self.shared = shared
+		self.timeout = timeout
+		if f is not None:
+			self._set_function(f)
+
+	def _set_function(self, f):
+		self.f = f
+		self.__name__ = f.__name__
+		self.__doc__ = f.__doc__
+		self.stats_name = '%s.%s' % (f.__module__, f.__name__)
+
+	def __call__(self, f):
+		# @cached_property(shared=True) - сначала создается дескриптор, потом ему передается функция
+		self._set_function(f)
+		return self
+
+	def __get__(self, obj, cls=None):
+		if obj is None:
+			return self
 		try:
-			return self._property_cache[f]
-		except AttributeError:
-			self._property_cache = {}
-			x = self._property_cache[f] = f(self)
+			x = obj.__dict__[self.__name__]
+			stats.incr(self.stats_name, 'hit')
 			return x
 		except KeyError:
-			x = self._property_cache[f] = f(self)
-			return x
+			pass
+		key = self._shared_key(obj) if self.shared else None
+		if key is None:
+			x = self._compute(obj)
+		else:
+			computed = []
+			x = get_or_compute(key, lambda: computed.append(1) or self._compute(obj), self.timeout)
+			if not computed:
+				stats.incr(self.stats_name, 'shared_hit')
+		return obj.__dict__.setdefault(self.__name__, x)
+
+	def __delete__(self, obj):
+		obj.__dict__.pop(self.__name__, None)
+		if self.shared:
+			key = self._shared_key(obj)
+			if key is not None:
+				cache.delete(key)
+
+	def _compute(self, obj):
+		stats.incr(self.stats_name, 'miss')
+		start = time()
+		x = self.f(obj)
+		stats.timing(self.stats_name, 'compute', time() - start)
+		return x
+
+	def _shared_key(self, obj):
+		if getattr(obj, 'pk', None) is None:
+			# несохраненный объект - только локальное значение
+			return None
+		queryset = obj.__class__._default_manager.get_query_set()
+		if isinstance(queryset, CachedQuerySet) and queryset.row_versions:
+			version = queryset._row_versions([obj.pk], create=True)[obj.pk]
+			return '%s.prop.%s.%s' % (queryset._row_version_key(obj.pk), version, self.__name__)
+		return '%s.%s.%s.prop.%s' % (obj.__class__.__module__, obj.__class__.__name__,
+				obj.pk, self.__name__)
+
+
+_cached_properties = {}
+
+
+def get_cached_properties(cls):
+	"""Список (имя, cached_property) класса и его предков
+	"""
+	try:
+		return _cached_properties[cls]
+	except KeyError:
+		properties = {}
+		for klass in reversed(cls.__mro__):
+			for name, attr in klass.__dict__.iteritems():
+				if isinstance(attr, cached_property):
+					properties[name] = attr
+		result = _cached_properties[cls] = properties.items()
+		return result
 
-	return property(get)
+
+def invalidate_cached_properties(obj, *names, **kwargs):
+	"""Сбросить значения cached_property объекта с именами names (по умолчанию - все).
+	shared=False сбрасывает только значения в самом объекте, не трогая общий кеш.
+	"""
+	shared = kwargs.pop('shared', True)
+	for name, prop in get_cached_properties(obj.__class__):
+		if names and name not in names:
+			continue
+		if shared:
+			prop.__delete__(obj)
+		else:
+			obj.__dict__.pop(name, None)
+
+
+def _timeout(timeout):
+	return cache.default_timeout if timeout is None else timeout
+
+
+def pack(value, timeout=None, delta=0):
+	'''Обернуть значение для кеша в кортеж (значение, время истечения, время вычисления)
+	'''
+	return (value, time() + _timeout(timeout), delta)
+
+
+def needs_refresh(entry, beta=EARLY_REFRESH_BETA):
+	'''Пора ли пересчитывать значение из pack().
+
+	Истекшее значение пересчитывается всегда, а еще не истекшее - с вероятностью,
+	которая растет по мере приближения к времени истечения и с ростом времени
+	вычисления (алгоритм XFetch). Так горячие ключи пересчитывает один запрос
+	заранее, а не все запросы разом после истечения.
+	'''
+	value, expires, delta = entry
+	return time() - delta * beta * ln(1.0 - random()) >= expires
+
+
+def set_packed(key, value, timeout=None, delta=0, stale_timeout=STALE_TIMEOUT):
+	'''Занести значение в кеш через pack(). В кеше оно живет еще stale_timeout
+	секунд после истечения, что бы его можно было отдавать пока идет пересчет.
+	'''
+	cache.set(key, pack(value, timeout, delta), _timeout(timeout) + stale_timeout)
+
+
+def set_many_packed(items, timeout=None, delta=0, stale_timeout=STALE_TIMEOUT):
+	cache.set_many(dict((key, pack(value, timeout, delta)) for key, value in items.iteritems()),
+			_timeout(timeout) + stale_timeout)
+
+
+def acquire_lock(key):
+	'''Взять блокировку на пересчет ключа. Получает ее только один процесс
+	'''
+	return cache.add('%s.lock' % key, 1, LOCK_TIMEOUT)
+
+
+def release_lock(key):
+	cache.delete('%s.lock' % key)
+
+
+def wait_for(key):
+	'''Подождать не дольше LOCK_WAIT секунд, пока другой процесс пересчитает ключ.
+	Возвращает значение из pack() или None
+	'''
+	deadline = time() + LOCK_WAIT
+	while time() < deadline:
+		sleep(LOCK_POLL_INTERVAL)
+		entry = cache.get(key)
+		if entry is not None:
+			return entry
+	return None
+
+
+def get_or_compute(key, compute, timeout=None, stale_timeout=STALE_TIMEOUT, stats_name=None):
+	'''Вернуть значение из кеша, а если его нет или пора его пересчитать - вычислить compute().
+
+	Пересчитывает значение только тот запрос, который взял блокировку. Остальные
+	получают устаревшее значение, а если его нет - ждут нового не дольше LOCK_WAIT секунд.
+	С stats_name попадания (hit, stale_hit) и время чтения из кеша (cache) считаются
+	в stats, а промахи должен считать сам compute().
+	'''
+	start = time()
+	entry = cache.get(key)
+	if stats_name:
+		stats.timing(stats_name, 'cache', time() - start)
+	if entry is not None and not needs_refresh(entry):
+		if stats_name:
+			stats.incr(stats_name, 'hit')
+		return entry[0]
+	locked = acquire_lock(key)
+	if not locked:
+		if entry is None:
+			entry = wait_for(key)
+		if entry is not None:
+			if stats_name:
+				stats.incr(stats_name, 'stale_hit')
+			return entry[0]
+	try:
+		start = time()
+		value = compute()
+		set_packed(key, value, timeout, time() - start, stale_timeout)
+		return value
+	finally:
+		if locked:
+			release_lock(key)
+
+
+# BaseCache.incr - это get() и set() с таймаутом по умолчанию, после него таймаут надо вернуть
+ATOMIC_INCR = getattr(type(cache).incr, 'im_func', None) is not BaseCache.incr.im_func
+
+
+def get_counter(key, initial):
+	'''Значение счетчика из кеша, а если его нет - initial
+	'''
+	value = cache.get(key)
+	if value is None:
+		cache.add(key, initial, COUNTER_TIMEOUT)
+		value = cache.get(key, initial)
+	return value
+
+
+def incr_counter(key, delta=1):
+	'''Увеличить счетчик в кеше. Если его там нет, он начинается заново от текущего времени,
+	поэтому после вытеснения счетчика из кеша старые значения не возвращаются.
+	'''
+	try:
+		value = cache.incr(key, delta)
+	except ValueError:
+		value = int(time() * 1000)
+		cache.set(key, value, COUNTER_TIMEOUT)
+		return value
+	if not ATOMIC_INCR:
+		cache.set(key, value, COUNTER_TIMEOUT)
+	return value
+
+
+def encode(obj):
+	'''Компактное представление объекта модели для кеша - кортеж значений полей
+	в порядке _meta.fields, то есть такой же, как строка, из которой QuerySet
+	создает объект. В отличие от pickle объекта в нем нет _state, кешей
+	и прочих аттрибутов экземпляра.
+	'''
+	return tuple(getattr(obj, field.attname) for field in obj._meta.fields)
+
+
+class Tombstone(object):
+	'''Метка в кеше о том, что объекта с таким значением поля в базе нет
+	'''
+
+
+TOMBSTONE = Tombstone()
+
+
+class LocalCache(object):
+	'''Ограниченный по размеру LRU-кеш в памяти процесса.
+
+	Каждая запись живет не дольше timeout секунд и помнит поколение (см. Generation),
+	при котором была занесена. Запись другого поколения считается устаревшей.
+	Потокобезопасен.
+	'''
+	def __init__(self, size, timeout):
+		self.size = size
+		self.timeout = timeout
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, generation):
+		with self._lock:
+			try:
+				expires, _generation, value = self._data.pop(key)
+			except KeyError:
+				return None
+			if _generation != generation or expires < time():
+				return None
+			# переносим запись в конец, как самую свежую
+			self._data[key] = (expires, _generation, value)
+			return value
+
+	def set(self, key, value, generation):
+		with self._lock:
+			self._data.pop(key, None)
+			self._data[key] = (time() + self.timeout, generation, value)
+			while len(self._data) > self.size:
+				self._data.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+
+class Generation(object):
+	'''Счетчик поколений (версий), который хранится в общем кеше и виден всем процессам.
+
+	Что бы не ходить в кеш при каждом чтении, значение запоминается в процессе
+	на check_interval секунд. Начальное значение берется от текущего времени,
+	поэтому после вытеснения счетчика из кеша старые поколения не возвращаются.
+	'''
+	def __init__(self, key, check_interval=1):
+		self.key = key
+		self.check_interval = check_interval
+		self._value = None
+		self._checked = 0
+
+	def get(self):
+		now = time()
+		if self._value is None or now - self._checked > self.check_interval:
+			self._value, self._checked = get_counter(self.key, int(now * 1000)), now
+		return self._value
+
+	def incr(self, delta=1):
+		value = incr_counter(self.key, delta)
+		self._value, self._checked = value, time()
+		return value
+
+
+_local_caches = {}
+_generations = {}
+_versions = {}
+
+
+def get_local_cache(model):
+	'''Локальный кеш процесса для модели.
+	Возвращает None, если у модели не указан аттрибут local_cache_size.
+	'''
+	size = getattr(model, 'local_cache_size', 0)
+	if not size:
+		return None
+	try:
+		return _local_caches[model]
+	except KeyError:
+		local_cache = _local_caches[model] = LocalCache(size, getattr(model, 'local_cache_timeout', 5))
+		return local_cache
+
+
+def get_generation(model):
+	'''Поколение локальных кешей модели, общее для всех процессов
+	'''
+	try:
+		return _generations[model]
+	except KeyError:
+		generation = _generations[model] = Generation(
+				'%s.%s.generation' % (model.__module__, model.__name__),
+				getattr(model, 'local_cache_check_interval', 1))
+		return generation
+
+
+def get_version(model):
+	'''Версия модели, которая входит в каждый ключ кеша модели (см. CachedQuerySet._gen_cache_key)
+	'''
+	try:
+		return _versions[model]
+	except KeyError:
+		version = _versions[model] = Generation(
+				'%s.%s.version' % (model.__module__, model.__name__),
+				getattr(model, 'cache_version_check_interval', 1))
+		return version
+
+
+def invalidate_model(model):
+	'''Сбросить разом весь кеш модели: после увеличения версии модели
+	ни один из старых ключей больше не читается, а сами они вытесняются из кеша со временем.
+	'''
+	log.debug('Invalidate cache of %s.%s', model.__module__, model.__name__)
+	get_version(model).incr()
+	if get_local_cache(model) is not None:
+		get_generation(model).incr()
 
 
 class CachedQuerySet(models.query.QuerySet):
@@ -35,6 +411,53 @@ class CachedQuerySet(models.query.QuerySet):
 		если в базе есть две записи в одной модели name='Петя' и name='петя', и в самой модели
 		указано свойство cached_attrs=['name__iexact'] то будет возвращаться тот объект,
 		который первым был занесен в кеш.	
+
+	Если в модели указан аттрибут local_cache_size, то перед общим кешем появляется
+	второй уровень - LRU-кеш в памяти процесса на local_cache_size объектов, которые
+	живут local_cache_timeout секунд (по умолчанию 5). insert_to_cache и delete_from_cache
+	увеличивают поколение модели в общем кеше, и все процессы сбрасывают свой локальный
+	кеш этой модели не позже чем через local_cache_check_interval секунд (по умолчанию 1).
+
+	Если объекта нет в базе, то в кеш на cached_miss_timeout секунд (по умолчанию 30)
+	заносится метка Tombstone, и до ее истечения get() сразу вызывает DoesNotExist.
+	Метка перетирается при insert_to_cache, то есть при сохранении CachedModel.
+	cached_miss_timeout = 0 отключает метки.
+
+	Объекты живут в кеше cache_timeout секунд (по умолчанию - как настроен кеш) и
+	еще cache_stale_timeout секунд (по умолчанию STALE_TIMEOUT) после этого. При промахе или
+	истечении в базу идет только один запрос (см. get_or_compute), а горячие ключи
+	пересчитываются заранее (см. needs_refresh).
+
+	В каждый ключ входит версия модели, поэтому invalidate_model() сбрасывает весь
+	кеш модели одним инкрементом. update() этого QuerySet сбрасывает кеш только измененных
+	строк, а если их больше UPDATE_ROWS_LIMIT или QuerySet без условий - весь кеш модели. Удаленные
+	объекты CachedModel убирает из кеша обработчик post_delete, который Django вызывает
+	и для QuerySet.delete(), и для каждого объекта при каскадном удалении.
+	Если в модели указан аттрибут cache_row_versions = True, то у каждой строки есть
+	своя версия: объект в кеше хранится вместе с ней, а insert_to_cache и delete_from_cache
+	увеличивают ее, поэтому сбрасываются все ключи строки, в том числе ключи по старым
+	значениям измененных полей. Версию строки нельзя встроить в сам ключ (при поиске
+	по name строка еще не известна), поэтому она проверяется отдельным чтением из кеша.
+	Версии строк включаются и для моделей с @cached_property(shared=True).
+	Записи с версией строки хранятся в другом виде, поэтому в их ключах после версии
+	модели стоит пометка r, и записи, занесенные до включения версий, не читаются.
+
+	В общем кеше объект хранится один раз, под ключом по id, в виде кортежа значений
+	полей (см. encode), а под ключами по остальным cached_attrs лежит только его pk.
+	Объект собирается заново при чтении. Ссылка, которая осталась от старого значения
+	поля, отбрасывается, так как поле собранного объекта с ключом уже не совпадает.
+
+	Попадания (local_hit, hit, stale_hit, tombstone_hit), промахи, записи, удаления,
+	время чтения из кеша (cache) и из базы (db) считаются в stats по 'app.Model.attr'.
+	tombstone_hit - это запросы в базу, которые не понадобились благодаря меткам,
+	uncached - значения, которые get_many QuerySet с условиями достал из базы мимо кеша.
+
+	prefetch_cached('author', 'category') подгружает объекты по ForeignKey сразу для
+	пачки объектов: одним чтением из кеша (get_many) и одним запросом в базу для промахов.
+
+	Кеш используется только для QuerySet без своих условий (Model.objects.get(attr=value)):
+	в ключ входят только поле и значение, поэтому filter(), связанные менеджеры
+	(author.book_set), срезы, select_related и only()/defer() идут прямо в базу.
 	'''	
 	def __init__(self, model=None, query=None, using=None):
 		super(CachedQuerySet, self).__init__(model, query, using)
@@ -42,6 +465,40 @@ class CachedQuerySet(models.query.QuerySet):
 		if 'id' not in self.cached_attrs:
 			self.cached_attrs.append('id')
 		self.cached_attrs = [self._normalize_attr(attr) for attr in self.cached_attrs]
+		self.local_cache = get_local_cache(self.model)
+		self.generation = get_generation(self.model)
+		self.version = get_version(self.model)
+		self.row_versions = getattr(self.model, 'cache_row_versions', False) or \
+				any(prop.shared for name, prop in get_cached_properties(self.model))
+		self._entry_format = 'r' if self.row_versions else ''
+		self.cache_timeout = getattr(self.model, 'cache_timeout', None)
+		self.cache_stale_timeout = getattr(self.model, 'cache_stale_timeout', STALE_TIMEOUT)
+		fields = [field.attname for field in self.model._meta.fields]
+		self._pk_index = fields.index(self.model._meta.pk.attname)
+		self._prefetch_cached = ()
+
+	def __getstate__(self):
+		# локальный кеш процесса содержит Lock и не должен попадать в pickle
+		obj_dict = super(CachedQuerySet, self).__getstate__()
+		del obj_dict['local_cache'], obj_dict['generation'], obj_dict['version']
+		return obj_dict
+
+	def __setstate__(self, obj_dict):
+		self.__dict__.update(obj_dict)
+		self.local_cache = get_local_cache(self.model)
+		self.generation = get_generation(self.model)
+		self.version = get_version(self.model)
+
+	def _clone(self, klass=None, setup=False, **kwargs):
+		kwargs.setdefault('_prefetch_cached', self._prefetch_cached)
+		return super(CachedQuerySet, self)._clone(klass, setup, **kwargs)
+
+	def _cacheable(self):
+		'''Можно ли отвечать из кеша: у QuerySet нет условий, среза, select_related и отложенных полей
+		'''
+		query = self.query
+		return not query.where.children and not query.low_mark and query.high_mark is None \
+				and not query.select_related and not query.deferred_loading[0]
 
 	def _normalize_attr(self, attr):
 		return attr if '__' in attr else '%s__exact' % attr
@@ -49,18 +506,152 @@ class CachedQuerySet(models.query.QuerySet):
 	def _gen_cache_key(self, attr, value):
 		if attr.endswith('__iexact'):
 			value = value.lower()
-		return '%s.%s.%s.%s' % (self.model.__module__, self.model.__name__, attr, value)
+		return '%s.%s.v%s%s.%s.%s' % (self.model.__module__, self.model.__name__,
+				self.version.get(), self._entry_format, attr, value)
+
+	def _row_version_key(self, pk):
+		return '%s.%s.v%s.row.%s' % (self.model.__module__, self.model.__name__,
+				self.version.get(), pk)
+
+	def _row_versions(self, pks, create=False):
+		'''Словарь {pk: версия строки}. Если create, то отсутствующие в кеше версии создаются
+		'''
+		keys = dict((self._row_version_key(pk), pk) for pk in pks)
+		if not keys:
+			return {}
+		versions = cache.get_many(keys.keys())
+		if create:
+			initial = int(time() * 1000)
+			for key in keys:
+				if key not in versions:
+					versions[key] = get_counter(key, initial)
+		return dict((keys[key], version) for key, version in versions.iteritems())
+
+	def _incr_row_version(self, pk):
+		incr_counter(self._row_version_key(pk))
+
+	def _decode(self, values):
+		if len(values) != len(self.model._meta.fields):
+			# запись осталась от другой схемы модели
+			return None
+		obj = self.model(*values)
+		obj._state.db = self.db
+		return obj
+
+	def _read_entries(self, attr, keys):
+		'''Прочитать из общего кеша записи по ключам поля attr и собрать из них объекты.
+
+		Возвращает словарь {ключ: (объект или Tombstone, время истечения, время вычисления)}.
+		Промахов, записей с изменившейся версией строки и ссылок на строки,
+		у которых поле уже не совпадает с ключом, в нем нет.
+		'''
+		start = time()
+		entries = dict((key, entry) for key, entry in cache.get_many(keys).iteritems()
+				if entry is not None)
+		if attr != 'id__exact':
+			# под остальными ключами лежат ссылки на pk, достаем записи по ним
+			refs = dict((key, self._gen_cache_key('id__exact', entry[0]))
+					for key, entry in entries.iteritems() if not isinstance(entry[0], Tombstone))
+			primaries = cache.get_many(set(refs.itervalues())) if refs else {}
+			for key, primary_key in refs.iteritems():
+				if primaries.get(primary_key) is None:
+					del entries[key]
+				else:
+					entries[key] = primaries[primary_key]
+
+		versions = None
+		if self.row_versions:
+			versions = self._row_versions(set(entry[0][0][self._pk_index]
+					for entry in entries.itervalues() if not isinstance(entry[0], Tombstone)))
+
+		field = attr.split('__')[0]
+		result = {}
+		for key, (value, expires, delta) in entries.iteritems():
+			if not isinstance(value, Tombstone):
+				if versions is not None:
+					value, row_version = value
+					if versions.get(value[self._pk_index]) != row_version:
+						continue
+				value = self._decode(value)
+				if value is None or self._gen_cache_key(attr, getattr(value, field)) != key:
+					continue
+			result[key] = (value, expires, delta)
+		stats.timing(self._stats_name(attr), 'cache', time() - start)
+		return result
+
+	def _local_get(self, key):
+		if self.local_cache is None:
+			return None
+		obj = self.local_cache.get(key, self.generation.get())
+		# отдаем копию, что бы изменения объекта не попали в кеш процесса
+		return obj if obj is None else copy(obj)
+
+	def _local_set_many(self, items):
+		if self.local_cache is None:
+			return
+		generation = self.generation.get()
+		for key, obj in items.iteritems():
+			self.local_cache.set(key, copy(obj), generation)
+
+	def _insert_tombstones(self, attr, keys, delta=0):
+		timeout = getattr(self.model, 'cached_miss_timeout', 30)
+		if not timeout or not keys or not self._cacheable():
+			return
+		items = dict((key, TOMBSTONE) for key in keys)
+		set_many_packed(items, timeout, delta, 0)
+		self._local_set_many(items)
+		stats.incr(self._stats_name(attr), 'tombstone_set', len(items))
+
+	def _stats_name(self, attr):
+		return '%s.%s.%s' % (self.model._meta.app_label, self.model._meta.object_name, attr)
+
+	def _local_invalidate(self):
+		if self.local_cache is not None:
+			self.generation.incr()
+
+	def invalidate_model(self):
+		'''Сбросить весь кеш модели (см. invalidate_model)
+		'''
+		invalidate_model(self.model)
 
 	def insert_to_cache(self, obj):
-		for attr in self.cached_attrs:
-			field, _filter = attr.split('__')
-			value = getattr(obj, field)
-			key = self._gen_cache_key(attr, value)
-			if attr == 'id__exact':
-				log.debug('Set to cache: %s', key)
-			cache.set(key, obj)
+		log.debug('Set to cache: %s', self._gen_cache_key('id__exact', obj.id))
+		self._local_invalidate()
+		if self.row_versions:
+			self._incr_row_version(obj.pk)
+		self.insert_many_to_cache([obj])
+
+	def insert_many_to_cache(self, objs, delta=0):
+		'''Занести в кеш сразу несколько объектов одним вызовом cache.set_many.
+		В отличие от insert_to_cache не сбрасывает локальные кеши процессов,
+		поэтому подходит только для неизмененных объектов из базы.
+		delta - сколько секунд заняло получение объектов (см. needs_refresh)
+		'''
+		if not objs:
+			return
+		versions = None
+		if self.row_versions:
+			versions = self._row_versions(set(obj.pk for obj in objs), create=True)
+		items, local_items = {}, {}
+		for obj in objs:
+			for attr in self.cached_attrs:
+				field, _filter = attr.split('__')
+				key = self._gen_cache_key(attr, getattr(obj, field))
+				local_items[key] = obj
+				stats.incr(self._stats_name(attr), 'set')
+				if attr == 'id__exact':
+					values = encode(obj)
+					items[key] = values if versions is None else (values, versions[obj.pk])
+				else:
+					items[key] = obj.pk
+		log.debug('Set to cache %s keys', len(items))
+		set_many_packed(items, self.cache_timeout, delta, self.cache_stale_timeout)
+		self._local_set_many(local_items)
 
 	def delete_from_cache(self, obj):
+		self._local_invalidate()
+		if self.row_versions:
+			self._incr_row_version(obj.pk)
 		for attr in self.cached_attrs:
 			field, _filter = attr.split('__')
 			value = getattr(obj, field)
@@ -68,25 +659,245 @@ class CachedQuerySet(models.query.QuerySet):
 			if attr == 'id__exact':
 				log.debug('Delete from cache: %s', key)
 			cache.delete(key)
+			stats.incr(self._stats_name(attr), 'delete')
+
+	def _invalidate_rows(self, pks, values):
+		'''Сбросить кеш строк pks после update(**values): их записи по id (ссылки по остальным
+		полям без них не читаются) и записи, в том числе метки Tombstone, по новым значениям полей
+		'''
+		self._local_invalidate()
+		keys = [self._gen_cache_key('id__exact', pk) for pk in pks]
+		for attr in self.cached_attrs:
+			field = attr.split('__')[0]
+			if field in values and not isinstance(values[field], ExpressionNode):
+				keys.append(self._gen_cache_key(attr, values[field]))
+		cache.delete_many(keys)
+		if self.row_versions:
+			for pk in pks:
+				self._incr_row_version(pk)
+
+	def get_many(self, attr, values):
+		'''Вернуть словарь {значение: объект} для списка значений поля attr.
+
+		Все ключи читаются из кеша одним cache.get_many, промахи достаются
+		из базы одним запросом WHERE attr IN (...) и заносятся в кеш через set_many.
+		Значения, для которых в базе нет объектов, в словарь не попадают
+		и помечаются в кеше как отсутствующие (см. Tombstone).
+		Для QuerySet с условиями (см. _cacheable) все значения достаются из базы.
+
+		Args:
+			attr - поле из cached_attrs модели (например 'id' или 'name__iexact')
+			values - список значений этого поля
+		'''
+		attr = self._normalize_attr(attr)
+		if attr not in self.cached_attrs:
+			raise ValueError('%s is not in cached_attrs of %s' % (attr, self.model.__name__))
+		keys = dict((self._gen_cache_key(attr, value), value) for value in values)
+		result, missed = {}, []
+		if not keys:
+			return result
+
+		name = self._stats_name(attr)
+		cacheable = self._cacheable()
+		shared_keys = []
+		if not cacheable:
+			missed = keys.values()
+		else:
+			for key, value in keys.iteritems():
+				obj = self._local_get(key)
+				if obj is None:
+					shared_keys.append(key)
+				elif isinstance(obj, Tombstone):
+					stats.incr(name, 'tombstone_hit')
+				else:
+					stats.incr(name, 'local_hit')
+					result[value] = obj
+
+		if shared_keys:
+			log.debug('Get many from cache: %s keys', len(shared_keys))
+			cached = self._read_entries(attr, shared_keys)
+			found = {}
+			for key in shared_keys:
+				entry = cached.get(key)
+				# истекшие и досрочно пересчитываемые значения достаем из базы
+				obj = entry[0] if entry is not None and not needs_refresh(entry) else None
+				if isinstance(obj, Tombstone):
+					found[key] = obj
+					stats.incr(name, 'tombstone_hit')
+				elif obj:
+					result[keys[key]] = found[key] = obj
+					stats.incr(name, 'hit')
+				else:
+					missed.append(keys[key])
+			self._local_set_many(found)
+
+		if missed:
+			log.debug('\tNot found %s keys!', len(missed))
+			# QuerySet с условиями кеш не читает, это не промахи
+			stats.incr(name, 'miss' if cacheable else 'uncached', len(missed))
+			field, _filter = attr.split('__')
+			start = time()
+			if _filter == 'iexact':
+				# для регистронезависимых полей IN не подходит
+				query = reduce(operator.or_, [Q(**{attr: value}) for value in missed])
+				db_result = list(self.filter(query))
+			else:
+				db_result = list(self.filter(**{'%s__in' % field: missed}))
+			delta = time() - start
+			stats.timing(name, 'db', delta)
+			missed_keys = set(self._gen_cache_key(attr, value) for value in missed)
+			for obj in db_result:
+				key = self._gen_cache_key(attr, getattr(obj, field))
+				if key in keys:
+					result[keys[key]] = obj
+					missed_keys.discard(key)
+			if cacheable:
+				# отсутствие строки в отфильтрованном QuerySet не значит, что ее нет в базе
+				self.insert_many_to_cache(db_result, delta)
+				self._insert_tombstones(attr, missed_keys, delta)
+
+		return result
+
+	def in_bulk(self, id_list):
+		'''То же что и QuerySet.in_bulk, только объекты берутся из кеша (см. get_many)
+		'''
+		assert self.query.can_filter(), \
+				"Cannot use 'limit' or 'offset' with in_bulk"
+		assert isinstance(id_list, (tuple, list, set, frozenset)), \
+				"in_bulk() must be provided with a list of IDs."
+		return dict((obj.pk, obj) for obj in self.get_many('id', id_list).itervalues())
+
+	def _shared_get(self, attr, key, fetch):
+		'''Достать объект из общего кеша, а если его там нет или его пора
+		пересчитать - из базы через fetch(). В базу идет только тот запрос,
+		который взял блокировку, остальные получают устаревший объект или ждут нового.
+		'''
+		log.debug('Get from cache: %s', key)
+		name = self._stats_name(attr)
+		entry = self._read_entries(attr, [key]).get(key)
+		if entry is not None and not needs_refresh(entry):
+			self._local_set_many({key: entry[0]})
+			stats.incr(name, 'tombstone_hit' if isinstance(entry[0], Tombstone) else 'hit')
+			return entry[0]
+		locked = acquire_lock(key)
+		if not locked:
+			if entry is None and wait_for(key) is not None:
+				entry = self._read_entries(attr, [key]).get(key)
+			if entry is not None:
+				stats.incr(name, 'tombstone_hit' if isinstance(entry[0], Tombstone) else 'stale_hit')
+				return entry[0]
+		try:
+			return self._fetch(attr, key, fetch)
+		finally:
+			if locked:
+				release_lock(key)
+
+	def _fetch(self, attr, key, fetch):
+		log.debug('\tNot found!')
+		name = self._stats_name(attr)
+		stats.incr(name, 'miss')
+		start = time()
+		try:
+			obj = fetch()
+		except self.model.DoesNotExist:
+			stats.timing(name, 'db', time() - start)
+			self._insert_tombstones(attr, [key], time() - start)
+			return TOMBSTONE
+		stats.timing(name, 'db', time() - start)
+		self.insert_many_to_cache([obj], time() - start)
+		return obj
+
+	def prefetch_cached(self, *fields):
+		'''Вернуть QuerySet, который для каждых PREFETCH_CHUNK_SIZE объектов
+		достает объекты по ForeignKey fields разом и кладет их в кеш связи объекта,
+		так что obj.author уже не делает отдельного запроса.
+
+		Если модель по связи кешируется (ее менеджер по умолчанию - CachedManager), то
+		объекты берутся через get_many, иначе - одним запросом WHERE ... IN (...).
+		'''
+		for name in fields:
+			field = self.model._meta.get_field(name)
+			if not isinstance(field, models.ForeignKey):
+				raise ValueError('%s is not a ForeignKey of %s' % (name, self.model.__name__))
+		return self._clone(_prefetch_cached=self._prefetch_cached + fields)
+
+	def iterator(self):
+		iterator = super(CachedQuerySet, self).iterator()
+		if not self._prefetch_cached:
+			return iterator
+		return self._prefetch_iterator(iterator)
+
+	def _prefetch_iterator(self, iterator):
+		chunk = []
+		for obj in iterator:
+			chunk.append(obj)
+			if len(chunk) >= PREFETCH_CHUNK_SIZE:
+				self._prefetch(chunk)
+				for obj in chunk:
+					yield obj
+				chunk = []
+		if chunk:
+			self._prefetch(chunk)
+			for obj in chunk:
+				yield obj
+
+	def _prefetch(self, objs):
+		for name in self._prefetch_cached:
+			field = self.model._meta.get_field(name)
+			cache_name = field.get_cache_name()
+			values = set(getattr(obj, field.attname) for obj in objs
+					if not hasattr(obj, cache_name))
+			values.discard(None)
+			if not values:
+				continue
+			rel_field = field.rel.get_related_field()
+			queryset = field.rel.to._default_manager.get_query_set()
+			if isinstance(queryset, CachedQuerySet) and \
+					queryset._normalize_attr(rel_field.name) in queryset.cached_attrs:
+				related = queryset.get_many(rel_field.name, values)
+			else:
+				related = dict((getattr(rel_obj, rel_field.attname), rel_obj) for rel_obj in
+						queryset.filter(**{'%s__in' % rel_field.name: values}))
+			for obj in objs:
+				rel_obj = related.get(getattr(obj, field.attname))
+				if rel_obj is not None:
+					setattr(obj, cache_name, rel_obj)
 
 	def get(self, *args, **kwargs):
-		if len(kwargs) == 1:
+		if len(kwargs) == 1 and not args and self._cacheable():
 			attr, value = kwargs.items()[0]
 			attr = self._normalize_attr(attr)
 			if attr in self.cached_attrs:
 				key = self._gen_cache_key(attr, value)
-				try:
-					log.debug('Get from cache: %s', key)
-					cached_result = cache.get(key)
-					if not cached_result: raise KeyError
-				except KeyError:
-					log.debug('\tNot found!')
-					obj = super(CachedQuerySet, self).get(*args, **kwargs)
-					self.insert_to_cache(obj)
-					return obj
+				cached_result = self._local_get(key)
+				if cached_result is None:
+					cached_result = self._shared_get(attr, key,
+							lambda: super(CachedQuerySet, self).get(*args, **kwargs))
+				else:
+					stats.incr(self._stats_name(attr),
+							'tombstone_hit' if isinstance(cached_result, Tombstone) else 'local_hit')
+				if isinstance(cached_result, Tombstone):
+					log.debug('\tTombstone!')
+					raise self.model.DoesNotExist("%s matching query does not exist."
+							% self.model._meta.object_name)
+				return cached_result
 
 		return super(CachedQuerySet, self).get(*args, **kwargs)
 
+	def update(self, **kwargs):
+		pks = None
+		if self.query.where.children:
+			pks = list(self.values_list('pk', flat=True)[:UPDATE_ROWS_LIMIT + 1])
+			if len(pks) > UPDATE_ROWS_LIMIT:
+				pks = None
+		rows = super(CachedQuerySet, self).update(**kwargs)
+		if pks is None:
+			self.invalidate_model()
+		else:
+			self._invalidate_rows(pks, kwargs)
+		return rows
+	update.alters_data = True
+
 	
 class CachedManager(models.Manager):
 	'''Добавьте к своей модели аттрибуты
@@ -104,6 +915,15 @@ class CachedManager(models.Manager):
 
 	def get_query_set(self):
 		return CachedQuerySet(self.model, using=self._db)
+
+	def get_many(self, attr, values):
+		return self.get_query_set().get_many(attr, values)
+
+	def prefetch_cached(self, *fields):
+		return self.get_query_set().prefetch_cached(*fields)
+
+	def invalidate_model(self):
+		return self.get_query_set().invalidate_model()
 	
 
 class CachedModel(models.Model):
@@ -114,11 +934,18 @@ class CachedModel(models.Model):
 
 	def save(self, force_insert=False, force_update=False, using=None):
 		super(CachedModel, self).save(force_insert, force_update, using)
+		# значения в общем кеше устаревают вместе с версией строки
+		invalidate_cached_properties(self, shared=False)
 		self.__class__.objects.all().insert_to_cache(self)
 
-	def delete(self, using=None):
-		self.__class__.objects.all().delete_from_cache(self)
-		super(CachedModel, self).delete(using)
-
 	class Meta:
-		abstract = True
\ No newline at end of file
+		abstract = True
+
+
+def delete_cached_model(sender, instance, **kwargs):
+	'''Убрать из кеша удаленный объект CachedModel, в том числе удаленный каскадно
+	'''
+	if issubclass(sender, CachedModel):
+		sender.objects.all().delete_from_cache(instance)
+
+models.signals.post_delete.connect(delete_cached_model)
@@ -137,15 +137,22 @@
 
 __all__ = ["takes", "InputParameterError", "returns", "ReturnValueError",
 		   "optional", "nothing", "anything", "list_of", "tuple_of", "dict_of",
-		   "by_regex", "with_attr", "one_of", "set_of"]
+		   "by_regex", "with_attr", "one_of", "set_of", "set_sampling",
+		   "set_container_sample", "set_profiling"]
 
 no_check = False # set this to True to turn all checks off
 
 ################################################################################
 
 from inspect import getargspec, isclass
+from itertools import count, imap, islice
+from random import randrange
+from time import time
 from types import NoneType
 from re import compile as regex
+import logging
+
+log = logging.getLogger(__name__)
 
 ################################################################################
 
@@ -159,6 +166,106 @@ def type_name(v):
 	"Returns the name of the passed value's type"
 	return type(v).__name__
 
+################################################################################
+#
+# Unlike no_check, the sampling mode can be changed at any time and applies
+# to the already decorated functions:
+#
+# set_sampling(100) # check 1 in 100 calls of each function, log the violations
+# set_sampling(1)   # check every call and raise on violations (the default)
+# set_sampling(0)   # check nothing
+#
+# With Django the initial mode is taken from the CONTRACTS_SAMPLE_RATE and
+# CONTRACTS_RAISE settings, the number of logged violations of each function
+# is kept in sampling.violations.
+#
+# list_of, tuple_of, set_of and dict_of check all the elements by default,
+#
+# set_container_sample(20) # check at most 20 elements of each container
+#
+# makes the cost of a check nearly independent of the container size: 20 evenly
+# spaced elements of a list or a tuple starting from a random one (any element
+# can be picked), 20 consecutive elements of a set or a dict starting from a
+# random position. The latter are consecutive in the iteration (hash) order, so
+# they are not independent of each other, and skipping to the position is a pass
+# in C over the skipped elements. The initial size is taken from the
+# CONTRACTS_CONTAINER_SAMPLE setting.
+#
+# set_profiling(libs.stats.Stats("contracts")) # or CONTRACTS_PROFILE = True
+#
+# records the time spent in the checks and in the decorated function itself
+# for each call, ./manage.py contracts_profile prints the functions whose
+# checks cost the most.
+#
+
+class Sampling(object):
+	def __init__(self):
+		self.rate = 1
+		self.raise_errors = True
+		self.violations = {} # "module.function" -> number of violations
+		self.container_sample = 0 # 0 - check all the elements of containers
+		self.profiler = None
+		self.configured = False
+
+	def configure(self):
+		"Takes the initial mode from the Django settings, if there are any"
+		self.configured = True
+		try:
+			from django.conf import settings
+			rate = getattr(settings, "CONTRACTS_SAMPLE_RATE", 1)
+			raise_errors = getattr(settings, "CONTRACTS_RAISE", None)
+			container_sample = getattr(settings, "CONTRACTS_CONTAINER_SAMPLE", 0)
+			profile = getattr(settings, "CONTRACTS_PROFILE", False)
+		except ImportError: # no Django or no settings module
+			return
+		set_sampling(rate, raise_errors)
+		set_container_sample(container_sample)
+		if profile:
+			from libs.stats import Stats
+			set_profiling(Stats("contracts"))
+
+	def violation(self, method, error):
+		"Raises the error or, if the violations are only logged, counts and logs it"
+		if self.raise_errors:
+			raise error
+		name = "%s.%s" % (method.__module__, method.__name__)
+		self.violations[name] = self.violations.get(name, 0) + 1
+		log.warning("Contract violation: %s", error)
+
+sampling = Sampling()
+
+def set_sampling(rate, raise_errors = None):
+	"""Check 1 in rate calls of each decorated function (0 - none), raise_errors
+	is whether to raise on violations, by default only if every call is checked"""
+	sampling.configured = True
+	sampling.rate = rate
+	sampling.raise_errors = rate == 1 if raise_errors is None else raise_errors
+
+SMALL_CONTAINER = 16 # containers up to this size are checked element by element
+
+def set_profiling(profiler):
+	"""Record the time of the checks and of the function body of each call,
+	profiler.timing(function name, "checks" or "body", seconds) is called for
+	them, None turns the profiling off"""
+	sampling.profiler = profiler
+
+def set_container_sample(size):
+	"Check at most size elements of each container (0 - all of them)"
+	sampling.container_sample = size
+
+def container_sample(items):
+	"Returns the elements of the container to check"
+	size = sampling.container_sample
+	if not size or len(items) <= size:
+		return items
+	if isinstance(items, (list, tuple)):
+		# every step-th element starting from a random one, a slice costs less than sample();
+		# the start goes up to the last one that still leaves size elements, so the tail is reached
+		step = len(items) // size
+		return items[randrange(len(items) - step * (size - 1))::step][:size]
+	start = randrange(len(items) - size + 1)
+	return list(islice(items, start, start + size))
+
 ################################################################################
 
 class Checker(object):
@@ -168,6 +275,17 @@ class Checker(object):
 	def check(self, value): # abstract
 		pass
 
+	def check_all(self, items):
+		"Checks the elements of a container, stops at the first failure"
+		return all(imap(self.check, items))
+
+	def compile(self, value, namespace):
+		"""Returns a python expression which is true if the variable named value
+		passes the check, the objects it refers to are added to namespace"""
+		name = "_check%d" % len(namespace)
+		namespace[name] = self.check
+		return "%s(%s)" % (name, value)
+
 	_registered = [] # a list of registered descendant class factories
 
 	@staticmethod
@@ -184,6 +302,23 @@ class TypeChecker(Checker):
 	def check(self, value):
 		return isinstance(value, self.reference)
 
+	def check_all(self, items):
+		reference = self.reference
+		# large containers usually hold a few distinct types, each is checked once;
+		# if that fails (old style classes, for example) the elements are checked
+		if len(items) > SMALL_CONTAINER and \
+		   all(issubclass(t, reference) for t in set(map(type, items))):
+			return True
+		for item in items:
+			if not isinstance(item, reference):
+				return False
+		return True
+
+	def compile(self, value, namespace):
+		name = "_type%d" % len(namespace)
+		namespace[name] = self.reference
+		return "isinstance(%s, %s)" % (value, name)
+
 Checker._registered.append((isclass, TypeChecker))
 
 nothing = NoneType
@@ -191,9 +326,34 @@ nothing = NoneType
 ################################################################################
 
 class StrChecker(Checker):
+	def __init__(self, reference):
+		Checker.__init__(self, reference)
+		self.matches = {} # type -> whether it conforms, the name is resolved once per type
+
 	def check(self, value):
-		value_base_names = base_names(type(value))
-		return self.reference in value_base_names or "instance" in value_base_names
+		value_type = type(value)
+		try:
+			return self.matches[value_type]
+		except KeyError:
+			return self.check_type(value_type)
+
+	def check_all(self, items):
+		if len(items) <= SMALL_CONTAINER:
+			return Checker.check_all(self, items)
+		matches = self.matches
+		return all(matches[t] if t in matches else self.check_type(t)
+				   for t in set(map(type, items)))
+
+	def check_type(self, value_type):
+		value_base_names = base_names(value_type)
+		result = self.matches[value_type] = \
+			self.reference in value_base_names or "instance" in value_base_names
+		return result
+
+	def compile(self, value, namespace):
+		name = "_names%d" % len(namespace)
+		namespace[name] = self.matches
+		return "(%s.get(type(%s)) or %s)" % (name, value, Checker.compile(self, value, namespace))
 
 Checker._registered.append((lambda x: isinstance(x, str), StrChecker))
 
@@ -202,10 +362,24 @@ Checker._registered.append((lambda x: isinstance(x, str), StrChecker))
 class TupleChecker(Checker):
 	def __init__(self, reference):
 		self.reference = map(Checker.create, reference)
+		# a tuple of plain types, like optional(int), checks containers as one type
+		if all(isinstance(c, TypeChecker) for c in self.reference):
+			self.check_all = TypeChecker(tuple(c.reference for c in self.reference)).check_all
 
 	def check(self, value):
 		return reduce(lambda r, c: r or c.check(value), self.reference, False)
 
+	def compile(self, value, namespace):
+		# plain types are merged into a single isinstance() call
+		types = tuple(c.reference for c in self.reference if isinstance(c, TypeChecker))
+		expressions = [c.compile(value, namespace) for c in self.reference
+					   if not isinstance(c, TypeChecker)]
+		if types:
+			expressions.insert(0, TypeChecker(types).compile(value, namespace))
+		if "True" in expressions:
+			return "True"
+		return "(%s)" % " or ".join(expressions) if expressions else "False"
+
 Checker._registered.append((lambda x: isinstance(x, tuple) and not
 filter(lambda y: Checker.create(y) is None,
 	   x),
@@ -219,6 +393,13 @@ class CallableChecker(Checker):
 	def check(self, value):
 		return self.reference(value)
 
+	def compile(self, value, namespace):
+		if self.reference is anything:
+			return "True"
+		name = "_check%d" % len(namespace)
+		namespace[name] = self.reference
+		return "%s(%s)" % (name, value)
+
 # note that the callable check is the most relaxed of all, therefore it should
 # be registered last, after all the more specific cases have been registered
 
@@ -233,8 +414,7 @@ class ListOfChecker(Checker):
 		self.reference = Checker.create(reference)
 
 	def check(self, value):
-		return isinstance(value, list) and\
-			   not filter(lambda e: not self.reference.check(e), value)
+		return isinstance(value, list) and self.reference.check_all(container_sample(value))
 
 list_of = lambda *args: ListOfChecker(*args).check
 
@@ -245,8 +425,7 @@ class TupleOfChecker(Checker):
 		self.reference = Checker.create(reference)
 
 	def check(self, value):
-		return isinstance(value, tuple) and\
-			   not filter(lambda e: not self.reference.check(e), value)
+		return isinstance(value, tuple) and self.reference.check_all(container_sample(value))
 
 tuple_of = lambda *args: TupleOfChecker(*args).check
 
@@ -257,8 +436,7 @@ class SetOfChecker(Checker):
 		self.reference = Checker.create(reference)
 
 	def check(self, value):
-		return isinstance(value, set) and\
-			   not filter(lambda e: not self.reference.check(e), value)
+		return isinstance(value, set) and self.reference.check_all(container_sample(value))
 
 set_of = lambda *args: SetOfChecker(*args).check
 
@@ -270,9 +448,11 @@ class DictOfChecker(Checker):
 		self.value_reference = Checker.create(value_reference)
 
 	def check(self, value):
-		return isinstance(value, dict) and\
-			   not filter(lambda e: not self.key_reference.check(e), value.iterkeys()) and\
-			   not filter(lambda e: not self.value_reference.check(e), value.itervalues())
+		if not isinstance(value, dict):
+			return False
+		keys = container_sample(value)
+		values = value.values() if keys is value else [value[k] for k in keys]
+		return self.key_reference.check_all(keys) and self.value_reference.check_all(values)
 
 dict_of = lambda *args: DictOfChecker(*args).check
 
@@ -311,6 +491,73 @@ one_of = lambda *args: OneOfChecker(*args).check
 
 ################################################################################
 
+def compile_proxy(name, method, target, checks, namespace, before_call = True):
+	"""Compiles the proxy function name for the method, which runs the checks
+	(lines of python source) before the call or, if before_call is false,
+	after it on its result"""
+
+	if not sampling.configured:
+		sampling.configure()
+	# methods of different classes share a name, the line tells them apart
+	code = getattr(target, "func_code", None)
+	profile_name = "%s.%s" % (target.__module__, target.__name__)
+	if code is not None:
+		profile_name += ":%d" % code.co_firstlineno
+	namespace.update(sampling = sampling, calls = count(), time = time, profile_name = profile_name)
+
+	# with a profiler the time of the checks is recorded, and the time of the
+	# function body is recorded by the innermost proxy, which calls the body
+
+	skip = "sampling.rate != 1 and (not sampling.rate or next(calls) % sampling.rate)"
+	checks = checks or ["pass"]
+	innermost = not hasattr(method, "_contract_target")
+	record_body = innermost and ["	profiler.timing(profile_name, 'body', called - start)"] or []
+
+	lines = ["def %s(*args, **kwargs):" % name,
+			 "	if sampling.profiler is not None:",
+			 "		return %s_profiled(args, kwargs)" % name]
+	if before_call:
+		lines += ["	if %s:" % skip,
+				  "		return method(*args, **kwargs)"] + \
+				 ["	" + line for line in checks] + \
+				 ["	return method(*args, **kwargs)",
+				  "",
+				  "def %s_profiled(args, kwargs):" % name,
+				  "	profiler = sampling.profiler",
+				  "	checked = time()",
+				  "	if not (%s):" % skip] + \
+				 ["		" + line for line in checks] + \
+				 ["	start = time()",
+				  "	profiler.timing(profile_name, 'checks', start - checked)",
+				  "	result = method(*args, **kwargs)",
+				  "	called = time()"] + record_body + \
+				 ["	return result"]
+	else:
+		lines += ["	result = method(*args, **kwargs)",
+				  "	if %s:" % skip,
+				  "		return result"] + \
+				 ["	" + line for line in checks] + \
+				 ["	return result",
+				  "",
+				  "def %s_profiled(args, kwargs):" % name,
+				  "	profiler = sampling.profiler",
+				  "	start = time()",
+				  "	result = method(*args, **kwargs)",
+				  "	called = time()"] + record_body + \
+				 ["	if not (%s):" % skip] + \
+				 ["		" + line for line in checks] + \
+				 ["	profiler.timing(profile_name, 'checks', time() - called)",
+				  "	return result"]
+
+	exec compile("\n".join(lines) + "\n", "<contracts for %s>" % method.__name__, "exec") in namespace
+	proxy = namespace[name]
+	proxy.__name__ = method.__name__
+	proxy.__module__ = target.__module__
+	proxy._contract_target = target # the function whose signature is checked
+	return proxy
+
+################################################################################
+
 def takes(*args, **kwargs):
 	"Method signature checking decorator"
 
@@ -339,37 +586,58 @@ def takes(*args, **kwargs):
 
 	else:
 		def takes_proxy(method):
-			method_args, method_defaults = getargspec(method)[0::3]
-
-			def takes_invocation_proxy(*args, **kwargs):
-				# append the default parameters
-
-				if method_defaults is not None and len(method_defaults) > 0\
-				and len(method_args) - len(method_defaults) <= len(args) < len(method_args):
-					args += method_defaults[len(args) - len(method_args):]
-
-				# check the types of the actual call parameters
-
-				for i, (arg, checker) in enumerate(zip(args, checkers)):
-					if not checker.check(arg):
-						raise InputParameterError("%s() got invalid parameter "
-												  "%d of type %s. Value was %s" %
-												  (method.__name__, i + 1,
-												   type_name(arg),
-												   str(arg)))
-
-				for kwname, checker in kwcheckers.iteritems():
-					if not checker.check(kwargs.get(kwname, None)):
-						raise InputParameterError("%s() got invalid parameter "
-												  "%s of type %s. Value was %s" %
-												  (method.__name__, kwname,
-												   type_name(kwargs.get(kwname, None)),
-												   str(kwname)))
-
-				return method(*args, **kwargs)
-
-			takes_invocation_proxy.__name__ = method.__name__
-			return takes_invocation_proxy
+			# the checks are compiled into the source of a proxy specialized for
+			# the method, so that a call costs a few isinstance() calls and
+			# no loops over the checkers
+
+			target = getattr(method, "_contract_target", method)
+			method_args, method_defaults = getargspec(target)[0::3]
+			method_defaults = method_defaults or ()
+			first_default = len(method_args) - len(method_defaults)
+
+			def invalid_parameter(i, value):
+				sampling.violation(method, InputParameterError("%s() got invalid parameter "
+															   "%d of type %s. Value was %s" %
+															   (method.__name__, i + 1,
+																type_name(value), str(value))))
+
+			def invalid_keyword_parameter(kwname, value):
+				sampling.violation(method, InputParameterError("%s() got invalid parameter "
+															   "%s of type %s. Value was %s" %
+															   (method.__name__, kwname,
+																type_name(value), str(value))))
+
+			namespace = {"method": method, "invalid_parameter": invalid_parameter,
+						 "invalid_keyword_parameter": invalid_keyword_parameter,
+						 "method_defaults": method_defaults}
+			lines = ["n = len(args)"]
+
+			# a positional checker also applies to its parameter passed
+			# by keyword or taken from the default value
+
+			for i, checker in enumerate(checkers):
+				expression = checker.compile("value", namespace)
+				if expression == "True":
+					continue
+				lines += ["if n > %d:" % i,
+						  "	value = args[%d]" % i,
+						  "	if not %s: invalid_parameter(%d, value)" % (expression, i)]
+				if i < len(method_args) and isinstance(method_args[i], str):
+					lines += ["elif %r in kwargs:" % method_args[i],
+							  "	value = kwargs[%r]" % method_args[i],
+							  "	if not %s: invalid_parameter(%d, value)" % (expression, i)]
+					if i >= first_default and not checker.check(method_defaults[i - first_default]):
+						lines += ["else:",
+								  "	invalid_parameter(%d, method_defaults[%d])" % (i, i - first_default)]
+
+			for kwname, checker in kwcheckers.iteritems():
+				expression = checker.compile("value", namespace)
+				if expression == "True":
+					continue
+				lines += ["value = kwargs.get(%r)" % kwname,
+						  "if not %s: invalid_keyword_parameter(%r, value)" % (expression, kwname)]
+
+			return compile_proxy("takes_invocation_proxy", method, target, lines, namespace)
 
 	return takes_proxy
 
@@ -394,23 +662,77 @@ def returns(sometype):
 
 	else:
 		def returns_proxy(method):
-			def returns_invocation_proxy(*args, **kwargs):
-				result = method(*args, **kwargs)
-
-				if not checker.check(result):
-					raise ReturnValueError("%s() has returned an invalid "
-										   "value of type %s. Value was %s" %
-										   (method.__name__, type_name(result), str(result)))
+			def invalid_result(result):
+				sampling.violation(method, ReturnValueError("%s() has returned an invalid "
+															"value of type %s. Value was %s" %
+															(method.__name__, type_name(result), str(result))))
 
-				return result
-
-			returns_invocation_proxy.__name__ = method.__name__
-			return returns_invocation_proxy
+			namespace = {"method": method, "invalid_result": invalid_result}
+			lines = ["if not %s: invalid_result(result)" % checker.compile("result", namespace)]
+			return compile_proxy("returns_invocation_proxy", method,
+								 getattr(method, "_contract_target", method), lines, namespace,
+								 before_call = False)
 
 	return returns_proxy
 
 class ReturnValueError(TypeError): pass
 
+################################################################################
+
+def benchmark(repeat = 200000):
+	"Prints the overhead of the checks per call, compared to an undecorated call"
+
+	from time import time
+
+	def plain(i, s, limit = None):
+		return i
+
+	class Target(object):
+		def plain(self, s):
+			return s
+		checked = takes("Target", basestring)(plain)
+
+	cases = [
+		("positional args", plain, takes(int, basestring, optional(int))(plain),
+		 (1, "a", 2), {}),
+		("default filled", plain, takes(int, basestring, optional(int))(plain),
+		 (1, "a"), {}),
+		("keyword arg", plain, takes(int, basestring, limit = optional(int))(plain),
+		 (1, "a"), {"limit": 2}),
+		("method, by name", Target().plain, Target().checked,
+		 ("a", ), {}),
+		("returns", plain, returns(int)(plain),
+		 (1, "a"), {}),
+	]
+
+	for rate in (1, 100):
+		set_sampling(rate)
+		print "1 in %s calls checked:" % rate
+		for title, plain_f, checked_f, args, kwargs in cases:
+			timings = []
+			for f in (plain_f, checked_f):
+				start = time()
+				for i in xrange(repeat):
+					f(*args, **kwargs)
+				timings.append(time() - start)
+			print "    %-18s %8.2f us per call" % (title, (timings[1] - timings[0]) / repeat * 1e6)
+	set_sampling(1)
+
+	checker = list_of(basestring)
+	for size in (0, 20):
+		set_container_sample(size)
+		print "list_of(basestring), %s elements checked:" % (size or "all")
+		for length in (150, 1500, 15000):
+			strings = [u"a"] * length
+			start = time()
+			for i in xrange(repeat / 100):
+				checker(strings)
+			print "    %-18s %8.2f us per call" % ("%s strings" % length, (time() - start) / (repeat / 100) * 1e6)
+	set_container_sample(0)
+
+if __name__ == "__main__":
+	benchmark()
+
 ################################################################################
 # EOF
 ## end of http://code.activestate.com/recipes/426123/ }}}
@@ -1,14 +1,29 @@
 #coding=utf-8
 #--- Author: Dmitri Patrakov <traditio@gmail.com>
 import logging
+from hashlib import md5
 
 from coffin.shortcuts import render_to_response
 from coffin.template import RequestContext
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import simplejson
+from django.utils.cache import patch_cache_control
 from django.utils.functional import wraps
 from annoying.decorators import *
 
 
+class JsonResponse(HttpResponse):
+    """
+    JsonResponse из annoying, но компактный: без пробелов после разделителей
+    и с не-ASCII символами как есть (в UTF-8), а не в виде \uXXXX.
+    """
+    def __init__(self, data):
+        self.data = data
+        content = simplejson.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'), ensure_ascii=False)
+        HttpResponse.__init__(self, content, mimetype='application/json; charset=utf-8')
+
+
 def render_to(template=None, mimetype="text/html"):
     def renderer(function):
         @wraps(function)
@@ -47,4 +62,33 @@ def ajax_request(func):
         else:
             return JsonResponse({'status': 'ok', 'response': response})
 
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def cache_response(max_age=60):
+    """
+    Ставит успешному ответу ETag по содержимому и Cache-Control: public, max-age,
+    что бы браузеры и прокси могли его переиспользовать. На запрос с If-None-Match,
+    равным ETag, отвечает 304 без тела. Ошибки из ajax_request не кешируются.
+
+    example:
+
+        @cache_response(max_age=300)
+        @ajax_request
+        def my_view(request):
+            ...
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            response = func(request, *args, **kwargs)
+            if response.status_code != 200 or getattr(response, 'data', {}).get('status') == 'error':
+                return response
+            etag = '"%s"' % md5(response.content).hexdigest()
+            if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                response = HttpResponseNotModified()
+            response['ETag'] = etag
+            patch_cache_control(response, public=True, max_age=max_age)
+            return response
+        return wrapper
+    return decorator
\ No newline at end of file
@@ -1,7 +1,12 @@
 #coding=utf-8
 #Original: https://github.com/Pitmairen/hamlish-jinja/blob/master/hamlish_jinja.py
 import re
+import os
 import os.path
+import codecs
+import logging
+import tempfile
+from hashlib import sha1
 
 
 from jinja2 import Environment, TemplateSyntaxError
@@ -10,6 +15,12 @@ from django.conf import settings
 
 __version__ = '0.1.0'
 
+log = logging.getLogger(__name__)
+
+INDENT_RE = re.compile(r'^(\s+)')
+TAG_RE = re.compile(r'^(\w+)(.*)$')
+SHORTCUT_RE = re.compile(r'^([\.#]\w+)')
+
 
 
 class HamlishExtension(Extension):
@@ -24,6 +35,8 @@ class HamlishExtension(Extension):
             hamlish_newline_string=getattr(settings, 'HAMLISH_NEWLINE_STRING', '\n'),
             hamlish_debug=getattr(settings, 'HAMLISH_DEBUG', False),
             hamlish_enable_div_shortcut=getattr(settings, 'HAMLISH_ENABLE_DIV_SHORTCUT', True),
+            hamlish_cache_dir=getattr(settings, 'HAMLISH_CACHE_DIR', None),
+            hamlish_cache_size=getattr(settings, 'HAMLISH_CACHE_SIZE', 50 * 1024 * 1024),
         )
 
 
@@ -32,14 +45,36 @@ class HamlishExtension(Extension):
             self.environment.hamlish_file_extensions:
             return source
 
+        cache = None
+        if self.environment.hamlish_cache_dir:
+            cache = ConversionCache(self.environment.hamlish_cache_dir,
+                    self.environment.hamlish_cache_size)
+            key = self.get_cache_key(source)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
         h = self.get_preprocessor(self.environment.hamlish_mode)
         try:
-            return h.convert_source(source)
+            result = h.convert_source(source)
         except TemplateIndentationError, e:
             raise TemplateSyntaxError(e.message, e.lineno, name=name, filename=filename)
         except TemplateSyntaxError, e:
             raise TemplateSyntaxError(e.message, e.lineno, name=name, filename=filename)
 
+        if cache is not None:
+            cache.set(key, result)
+        return result
+
+
+    def get_cache_key(self, source):
+        """The converted source depends on the source, the mode, the settings
+        of the output and the converter itself."""
+        env = self.environment
+        parts = [__version__, env.hamlish_mode, env.hamlish_indent_string,
+                env.hamlish_newline_string, str(env.hamlish_enable_div_shortcut), source]
+        return sha1(u'\0'.join(parts).encode('utf-8')).hexdigest()
+
 
     def get_preprocessor(self, mode):
 
@@ -61,6 +96,95 @@ class TemplateIndentationError(TemplateSyntaxError):
 
 
 
+class ConversionCache(object):
+    """Converted templates stored as files in a directory shared by all
+    the processes, so that a restarted process doesn't parse HAML again.
+
+    A file is written to a temporary one, unique for each thread, and renamed,
+    so readers never see a partial file. When the files take more than max_size bytes, the least
+    recently used ones are removed. The cache is best effort: any error of
+    the file system is logged and the template is just converted.
+    """
+
+    SUFFIX = '.jinja'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            f = codecs.open(path, 'r', 'utf-8')
+        except IOError:
+            return None
+        try:
+            result = f.read()
+        finally:
+            f.close()
+        try:
+            # the modification time is the last use, for the size cap
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(value.encode('utf-8'))
+            finally:
+                f.close()
+            # mkstemp creates files readable by the owner only
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+            self.trim()
+        except (IOError, OSError), e:
+            log.warning('Could not cache converted template in %s: %s', self.directory, e)
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def trim(self):
+        """Removes the least recently used files down to 90% of max_size,
+        if all of them take more than max_size"""
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_size:
+            return
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+
 class Hamlish(object):
 
     #Separator used for inline block data
@@ -154,7 +278,7 @@ A block is a tuple with this format:
 
 
             indent = 0
-            m = re.match(r'^(\s+)', line)
+            m = INDENT_RE.match(line)
             if m:
                 indent = m.group(1)
                 if ' ' in indent and '\t' in indent:
@@ -185,6 +309,17 @@ A block is a tuple with this format:
 
     def create_output(self, blocks, depth=0):
 
+        self._create_output(blocks, depth)
+
+        # the output is joined once, the nested blocks only append to it
+        if self.debug:
+            return ''.join(self.output.output)[1:]
+        return ''.join(self.output.output).strip()
+
+
+
+    def _create_output(self, blocks, depth):
+
         continued_block = None
 
 
@@ -204,7 +339,7 @@ A block is a tuple with this format:
 
                 # We remove one indent level for the block below the comment
                 # so whe won't add 1 to depth.
-                self.create_output(block[2], depth)
+                self._create_output(block[2], depth)
 
             #jinja tag
             elif block[1][0] == self.JINJA_TAG:
@@ -226,7 +361,7 @@ A block is a tuple with this format:
                 if not self.debug:
                     self.output.newline()
 
-                self.create_output(block[2], depth + 1)
+                self._create_output(block[2], depth + 1)
 
 
 
@@ -260,18 +395,13 @@ A block is a tuple with this format:
                 if not self.debug:
                     self.output.newline()
 
-                self.create_output(block[2], depth + 1)
+                self._create_output(block[2], depth + 1)
 
 
 
         self.close_continued_block(continued_block, depth)
 
 
-        if self.debug:
-            return ''.join(self.output.output)[1:]
-        return ''.join(self.output.output).strip()
-
-
 
     def close_continued_block(self, continued_block, depth):
         if continued_block is not None:
@@ -283,7 +413,7 @@ A block is a tuple with this format:
 
         line = block[1][1:]
 
-        m = re.match('^(\w+)(.*)$', line)
+        m = TAG_RE.match(line)
         if m is None:
             raise TemplateSyntaxError('Expected jinja tag, got "%s".' % line, block[0])
 
@@ -318,7 +448,7 @@ A block is a tuple with this format:
         if not self.debug: # and block[2]:
             self.output.newline()
 
-        self.create_output(block[2], depth + 1)
+        self._create_output(block[2], depth + 1)
 
         if not data and name not in self.self_closing_jinja_tags and continued_block is None\
             and block[2]:
@@ -334,7 +464,7 @@ A block is a tuple with this format:
 
     def parse_html_block(self, block, depth):
 
-        m = re.match('^(\w+)(.*)$', block[1][1:])
+        m = TAG_RE.match(block[1][1:])
 
         if m is None:
             raise TemplateSyntaxError('Expected html tag, got "%s".' % block[1][1:], block[0])
@@ -381,7 +511,7 @@ A block is a tuple with this format:
         if not self.debug:
             self.output.newline()
 
-        self.create_output(block[2], depth + 1)
+        self._create_output(block[2], depth + 1)
 
         if not data and not self_closing and block[2]:
             self._close_block(depth, lambda: self.output.close_html(tag))
@@ -398,7 +528,7 @@ A block is a tuple with this format:
         if not self.debug:
             self.output.write('\n')
 
-        self.create_output(block[2], depth + 1)
+        self._create_output(block[2], depth + 1)
 
 
     def parse_shortcuts(self, block, depth):
@@ -413,14 +543,19 @@ A block is a tuple with this format:
             self.output.indent(depth)
 
         if self.debug:
-
-            prev = []
-            while self.output.output[-1].isspace():
-                prev.append(self.output.output.pop())
+            # the closing tag goes before the trailing empty lines, which are
+            # moved after it in reverse order as one piece
+            output = self.output.output
+            i = len(output)
+            while i and output[i - 1].isspace():
+                i -= 1
+            prev = output[i:]
+            del output[i:]
 
         close_callback()
 
-        if self.debug:
+        if self.debug and prev:
+            prev.reverse()
             self.output.write(''.join(prev))
 
         if not self.debug:
@@ -432,7 +567,7 @@ A block is a tuple with this format:
         if ' ' in value:
             value, extra_attrs = value.split(' ', 1)
 
-        match = re.findall(r'^([\.#]\w+)', value)
+        match = SHORTCUT_RE.findall(value)
         
         classes = []
         ids = []
@@ -493,3 +628,52 @@ class Output(object):
     def write(self, data):
         self.output.append(data)
 
+
+
+def generate_template(width, depth):
+    """A template with width repeated sections, each nested depth levels deep,
+    which uses every kind of line the converter knows"""
+    lines = []
+    for i in xrange(width):
+        indent = ''
+        for level in xrange(depth):
+            lines.append('%s%%div.level%d#item-%d-%d title="{{ title }}"' % (indent, level, i, level))
+            lines.append('%s    -if items' % indent)
+            lines.append('%s        -for item in items' % indent)
+            lines.append('%s            %%li.item << {{ item }}' % indent)
+            lines.append('%s    -else' % indent)
+            lines.append('%s        %%p << Nothing here' % indent)
+            lines.append('')
+            lines.append('%s    ; a comment' % indent)
+            lines.append('%s    =title|safe' % indent)
+            lines.append('%s    %%br.' % indent)
+            lines.append('%s    |preformated text' % indent)
+            lines.append('%s    \\%%escaped line' % indent)
+            lines.append('%s    .shortcut << a \\' % indent)
+            lines.append('%s        continued line' % indent)
+            indent += '    '
+        lines.append('%splain text %d' % (indent, i))
+    return '\n'.join(lines)
+
+
+def benchmark():
+    """Conversion time of generated wide and deep templates in every mode"""
+    from time import time
+    modes = [('compact', Output(indent_string='', newline_string=''), False),
+             ('debug', Output(indent_string=' ', newline_string='\n'), True),
+             ('indented', Output(indent_string='    ', newline_string='\n'), False)]
+    print '%-10s %-8s %8s %10s %12s' % ('shape', 'mode', 'lines', 'ms', 'us/line')
+    for shape, width, depth in [('wide', 250, 1), ('wide', 1000, 1), ('wide', 4000, 1),
+                                ('deep', 1, 25), ('deep', 1, 50), ('deep', 1, 100)]:
+        source = generate_template(width, depth)
+        lines = source.count('\n') + 1
+        for mode, output, debug in modes:
+            start = time()
+            Hamlish(Output(output.indent_string, output.newline_string), debug, True).convert_source(source)
+            elapsed = time() - start
+            print '%-10s %-8s %8d %10.1f %12.1f' % ('%s x%d' % (shape, max(width, depth)), mode, lines,
+                                                   elapsed * 1000, elapsed / lines * 1e6)
+
+
+if __name__ == '__main__':
+    benchmark()
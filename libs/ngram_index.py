@@ -0,0 +1,278 @@
+#coding=utf-8
+'''Поиск по началу любого слова значения и по подстроке (через триграммы).
+
+WordIndex - инвертированный индекс в памяти процесса, FTSIndex - тот же поиск
+в таблицах SQLite FTS5, которые хранятся в файле и переживают перезапуск процессов.
+Модуль не зависит от Django. Замер скорости: python libs/ngram_index.py
+'''
+import re
+import sqlite3
+import threading
+from bisect import bisect_left, insort
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def split_words(value):
+	'''Слова значения в нижнем регистре
+	'''
+	return WORD_RE.findall(value.lower())
+
+
+def trigrams(value):
+	value = value.lower()
+	return set(value[i:i + 3] for i in xrange(len(value) - 2))
+
+
+def fts5_available():
+	'''Собран ли sqlite3 с FTS5 (триграммный токенайзер есть с SQLite 3.34)
+	'''
+	try:
+		sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE t USING fts5(value)')
+		return True
+	except sqlite3.OperationalError:
+		return False
+
+
+class WordIndex(object):
+	'''Инвертированный индекс: слово -> множество pk, и отсортированный список слов,
+	в котором слова с данным префиксом ищутся бинарным поиском.
+
+	Из нескольких слов запроса выбирается то, под которое подходит меньше всего слов
+	индекса; объекты перебираются по нему, а остальные слова запроса проверяются по
+	словам самого объекта. Перебор останавливается, как только набрано limit значений,
+	поэтому время поиска зависит от limit, а не от размера выборки.
+
+	С infix=True запрос из одного слова от трех символов ищется как подстрока: пересечением
+	множеств объектов по триграммам запроса с проверкой самой подстроки.
+
+	>>> items = [(1, u'Ivanov Petr'), (2, u'Petrov Ivan'), (3, u'Sidorov Petr')]
+	>>> index = WordIndex(items)
+	>>> index.find(u'petr')
+	[u'Ivanov Petr', u'Sidorov Petr', u'Petrov Ivan']
+	>>> index.find(u'Pe iv')
+	[u'Petrov Ivan', u'Ivanov Petr']
+	>>> index.find(u'dorov')
+	[]
+	>>> index = WordIndex(items, infix=True)
+	>>> index.find(u'dorov')
+	[u'Sidorov Petr']
+	>>> index.remove(3)
+	>>> index.find(u'dorov')
+	[]
+	'''
+	def __init__(self, items=(), infix=False):
+		self.infix = infix
+		self._values = {}
+		self._doc_words = {}
+		self._postings = {}
+		self._trigrams = {}
+		for item in items:
+			self._add(item[0], item[1])
+		self.words = sorted(self._postings)
+
+	def __len__(self):
+		return len(self._values)
+
+	def _add(self, pk, value):
+		self._values[pk] = value
+		self._doc_words[pk] = doc_words = tuple(set(split_words(value)))
+		new_words = []
+		for word in doc_words:
+			try:
+				self._postings[word].add(pk)
+			except KeyError:
+				self._postings[word] = set([pk])
+				new_words.append(word)
+		if self.infix:
+			for gram in trigrams(value):
+				self._trigrams.setdefault(gram, set()).add(pk)
+		return new_words
+
+	def add(self, pk, value, score=0):
+		'''Задать значение объекта pk (старое значение удаляется). score не используется
+		'''
+		self.remove(pk)
+		if value:
+			for word in self._add(pk, value):
+				insort(self.words, word)
+
+	def set_score(self, pk, score):
+		pass
+
+	def remove(self, pk):
+		value = self._values.pop(pk, None)
+		if value is None:
+			return
+		for word in self._doc_words.pop(pk):
+			postings = self._postings[word]
+			postings.discard(pk)
+			if not postings:
+				del self._postings[word]
+				del self.words[bisect_left(self.words, word)]
+		if self.infix:
+			for gram in trigrams(value):
+				postings = self._trigrams[gram]
+				postings.discard(pk)
+				if not postings:
+					del self._trigrams[gram]
+
+	def _range(self, prefix):
+		start = bisect_left(self.words, prefix)
+		end = bisect_left(self.words, prefix[:-1] + unichr(ord(prefix[-1]) + 1), start)
+		return start, end
+
+	def find(self, q, limit=None):
+		'''Различные значения, в которых каждое слово q - начало какого-нибудь слова значения
+		(а с infix=True и запросом от трех символов - значения, которые содержат q)
+		'''
+		tokens = split_words(q)
+		if not tokens:
+			return []
+		if self.infix and len(tokens) == 1 and len(tokens[0]) >= 3:
+			return self._find_infix(tokens[0], limit)
+		ranges = sorted((self._range(token), token) for token in tokens)
+		(start, end), token = min(ranges, key=lambda item: item[0][1] - item[0][0])
+		others = list(tokens)
+		others.remove(token)
+		pks = (pk for i in xrange(start, end) for pk in self._postings[self.words[i]])
+		if others:
+			pks = (pk for pk in pks if all(any(word.startswith(other) for word in self._doc_words[pk])
+					for other in others))
+		return self._collect(pks, limit)
+
+	def _find_infix(self, q, limit):
+		postings = sorted((self._trigrams.get(gram, ()) for gram in trigrams(q)), key=len)
+		if not postings[0]:
+			return []
+		rest = postings[1:]
+		pks = (pk for pk in postings[0] if all(pk in other for other in rest)
+				and q in self._values[pk].lower())
+		return self._collect(pks, limit)
+
+	def _collect(self, pks, limit):
+		result, seen = [], set()
+		for pk in pks:
+			value = self._values[pk]
+			if value not in seen:
+				seen.add(value)
+				result.append(value)
+				if limit and len(result) >= limit:
+					break
+		return result
+
+
+class FTSIndex(object):
+	'''Поиск WordIndex в таблице SQLite FTS5 table файла path (':memory:' - в памяти).
+
+	Слова разбирает токенайзер unicode61, подстроки (infix=True) ищутся по второй
+	таблице с токенайзером trigram. Один файл могут открывать несколько процессов:
+	SQLite сам блокирует его на время записи.
+	'''
+	def __init__(self, path, table, infix=False):
+		self.path = path
+		self.table = table
+		self.infix = infix
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		# prefix - отдельные индексы коротких префиксов, без них запрос из одной-двух букв
+		# перебирает все слова, которые с них начинаются
+		self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "%s" USING fts5(value, '
+				'tokenize="unicode61 remove_diacritics 0", prefix="1 2 3")' % table)
+		if infix:
+			self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "%s_trigram" USING fts5(value, '
+					'tokenize="trigram")' % table)
+		self.connection.commit()
+
+	def _tables(self):
+		return [self.table, '%s_trigram' % self.table] if self.infix else [self.table]
+
+	def __len__(self):
+		with self.lock:
+			return self.connection.execute('SELECT count(*) FROM "%s"' % self.table).fetchone()[0]
+
+	def add(self, pk, value, score=0):
+		self.add_many([(pk, value)])
+
+	def add_many(self, items):
+		'''Задать значения нескольких объектов одной транзакцией (пустое значение - удалить объект)
+		'''
+		items = [(item[0], item[1]) for item in items]
+		with self.lock:
+			for table in self._tables():
+				self.connection.executemany('DELETE FROM "%s" WHERE rowid = ?' % table,
+						[(pk,) for pk, value in items])
+				self.connection.executemany('INSERT INTO "%s" (rowid, value) VALUES (?, ?)' % table,
+						[(pk, value) for pk, value in items if value])
+			self.connection.commit()
+
+	def set_score(self, pk, score):
+		pass
+
+	def remove(self, pk):
+		with self.lock:
+			for table in self._tables():
+				self.connection.execute('DELETE FROM "%s" WHERE rowid = ?' % table, (pk,))
+			self.connection.commit()
+
+	def clear(self):
+		with self.lock:
+			for table in self._tables():
+				self.connection.execute('DELETE FROM "%s"' % table)
+			self.connection.commit()
+
+	def find(self, q, limit=None):
+		tokens = split_words(q)
+		if not tokens:
+			return []
+		if self.infix and len(tokens) == 1 and len(tokens[0]) >= 3:
+			table, match = '%s_trigram' % self.table, '"%s"' % tokens[0]
+		else:
+			table, match = self.table, ' '.join('"%s"*' % token for token in tokens)
+		with self.lock:
+			return [row[0] for row in self.connection.execute(
+					'SELECT DISTINCT value FROM "%s" WHERE "%s" MATCH ? LIMIT ?' % (table, table),
+					(match, limit or -1))]
+
+
+def benchmark(size=1000000, limit=10, repeat=200):
+	'''Время поиска по WordIndex и FTSIndex на size значений "Фамилия Имя Отчество"
+	'''
+	import random
+	from time import time
+	alphabet = u'абвгдежзиклмнопрстуфхцчшщэюя'
+	word = lambda: u''.join(random.choice(alphabet) for i in xrange(random.randint(4, 9))).capitalize()
+	names = [word() for i in xrange(size / 20)]
+	items = [(pk, u' '.join(random.choice(names) for i in xrange(3))) for pk in xrange(size)]
+	queries = [(u'%s', 'one word'), (u'%s %s', 'two words'), (u'%s', 'infix')]
+	engines = [('WordIndex', lambda infix: WordIndex(items, infix))]
+	if fts5_available():
+		engines.append(('FTSIndex', lambda infix: FTSIndex(':memory:', 'bench', infix)))
+	for name, build in engines:
+		for infix in (False, True):
+			start = time()
+			index = build(infix)
+			if isinstance(index, FTSIndex):
+				index.add_many(items)
+			print '%s(infix=%s): %s values built in %.1f s' % (name, infix, size, time() - start)
+			for pattern, title in queries:
+				if (title == 'infix') != infix:
+					continue
+				samples = []
+				for pk, value in random.sample(items, repeat):
+					parts = value.lower().split()
+					if title == 'infix':
+						samples.append(parts[1][1:4])
+					else:
+						samples.append(pattern % tuple(part[:random.randint(1, 4)] for part in parts[:pattern.count('%')]))
+				start = time()
+				for q in samples:
+					index.find(q, limit)
+				print '    %-10s %8.2f ms' % (title, (time() - start) / repeat * 1000)
+			del index
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
+	benchmark()
@@ -0,0 +1,199 @@
+#coding=utf-8
+'''Индекс строк для поиска по префиксу в памяти процесса.
+
+Значения хранятся в отсортированных массивах, поиск по префиксу - это два
+бинарных поиска и срез, без похода в кеш или базу. Модуль не зависит от Django.
+
+У значений может быть вес (популярность): тогда поиск отдает limit значений с наибольшим
+весом. Они выбираются кучей (heapq.nlargest) из наибольших весов разных значений
+за O(m + k log limit), где m - сколько значений начинается с префикса, а k - сколько
+среди них разных, а для коротких префиксов, под которые подходит большая часть
+индекса, запоминаются и сбрасываются только при изменении подходящих значений.
+Замер скорости от размера выборки: python libs/prefix_index.py
+'''
+import heapq
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from operator import itemgetter
+
+TOP_PREFIX_LENGTH = 2 # для префиксов не длиннее этого лучшие значения запоминаются
+
+
+class PrefixIndex(object):
+	'''Отсортированный индекс значений, каждое из которых принадлежит объекту с ключом pk.
+
+	keys - нормализованные значения (для регистронезависимого индекса - в нижнем регистре)
+	в порядке сортировки, values и pks - исходные значения и ключи объектов в том же порядке.
+	Одно и то же значение может быть у нескольких объектов, у объекта - одно значение.
+	find() отдает каждое значение один раз, в ranked индексе - с наибольшим из его весов.
+
+	>>> index = PrefixIndex([(1, u'Moscow'), (2, u'minsk'), (3, u'Madrid')], case_sensitive=False)
+	>>> index.find(u'm')
+	[u'Madrid', u'minsk', u'Moscow']
+	>>> index.add(3, u'Murmansk')
+	>>> index.find(u'M', 2)
+	[u'minsk', u'Moscow']
+	>>> index.remove(1)
+	>>> index.find(u'mo')
+	[]
+	>>> ranked = PrefixIndex([(1, u'Moscow', 12), (2, u'minsk', 2), (3, u'Madrid', 3)], ranked=True)
+	>>> ranked.find(u'M')
+	[u'Moscow', u'Madrid']
+	>>> ranked.set_score(3, 20)
+	>>> ranked.find(u'M', 1)
+	[u'Madrid']
+	>>> PrefixIndex([(1, u'Ivan'), (2, u'Ivan'), (3, u'Ivanov')]).find(u'Iv', 2)
+	[u'Ivan', u'Ivanov']
+	>>> PrefixIndex([(1, u'Ivan', 5), (2, u'Ivanov', 3), (3, u'Ivan', 1)], ranked=True).find(u'Iv')
+	[u'Ivan', u'Ivanov']
+	'''
+	def __init__(self, items=(), case_sensitive=True, ranked=False, top_size=10,
+			top_prefix_length=TOP_PREFIX_LENGTH):
+		'''items - пары (pk, значение) или, для ranked индекса, тройки (pk, значение, вес).
+		top_size - сколько лучших значений запоминать для коротких префиксов.
+		'''
+		self.case_sensitive = case_sensitive
+		self.ranked = ranked
+		self.top_size = top_size
+		self.top_prefix_length = top_prefix_length
+		entries = sorted((self.normalize(item[1]), item[1], item[0], item[2] if len(item) > 2 else 0)
+				for item in items if item[1])
+		self.keys = [entry[0] for entry in entries]
+		self.values = [entry[1] for entry in entries]
+		self.pks = [entry[2] for entry in entries]
+		self.scores = [entry[3] for entry in entries]
+		self._by_pk = dict((entry[2], entry[1]) for entry in entries)
+		self._top = {}
+
+	def __len__(self):
+		return len(self.keys)
+
+	def normalize(self, value):
+		return value if self.case_sensitive else value.lower()
+
+	def _range(self, prefix):
+		start = bisect_left(self.keys, prefix)
+		if not prefix:
+			return start, len(self.keys)
+		# первая строка, которая больше всех строк с этим префиксом
+		end = bisect_left(self.keys, prefix[:-1] + unichr(ord(prefix[-1]) + 1), start)
+		return start, end
+
+	def find(self, prefix, limit=None):
+		'''Значения, которые начинаются с prefix, не больше limit: в порядке сортировки,
+		а у ranked индекса - по убыванию веса
+		'''
+		prefix = self.normalize(prefix)
+		start, end = self._range(prefix)
+		if not self.ranked:
+			result, seen = [], set()
+			for value in islice(self.values, start, end):
+				if value not in seen:
+					seen.add(value)
+					result.append(value)
+					if limit is not None and len(result) >= limit:
+						break
+			return result
+		if limit is None:
+			limit = end - start
+		if len(prefix) <= self.top_prefix_length and limit <= self.top_size:
+			try:
+				top = self._top[prefix]
+			except KeyError:
+				top = self._top[prefix] = self._best(start, end, self.top_size)
+			return top[:limit]
+		return self._best(start, end, limit)
+
+	def _best(self, start, end, limit):
+		# наибольший вес каждого значения, при равных весах выше то, что раньше в индексе
+		best = {}
+		values, scores = self.values, self.scores
+		for i in xrange(start, end):
+			rank = (scores[i], -i)
+			if rank > best.get(values[i], (float('-inf'), 0)):
+				best[values[i]] = rank
+		if len(best) <= limit:
+			ranked = sorted(best.iteritems(), key=itemgetter(1), reverse=True)
+		else:
+			ranked = heapq.nlargest(limit, best.iteritems(), key=itemgetter(1))
+		return [value for value, rank in ranked]
+
+	def count(self, prefix):
+		start, end = self._range(self.normalize(prefix))
+		return end - start
+
+	def _position(self, pk, key):
+		i = bisect_left(self.keys, key)
+		while self.pks[i] != pk:
+			i += 1
+		return i
+
+	def _touch(self, key):
+		'''Сбросить запомненные лучшие значения префиксов key
+		'''
+		for length in xrange(min(len(key), self.top_prefix_length) + 1):
+			self._top.pop(key[:length], None)
+
+	def add(self, pk, value, score=0):
+		'''Задать значение объекта pk (старое значение удаляется)
+		'''
+		self.remove(pk)
+		if not value:
+			return
+		key = self.normalize(value)
+		i = bisect_right(self.keys, key)
+		self.keys.insert(i, key)
+		self.values.insert(i, value)
+		self.pks.insert(i, pk)
+		self.scores.insert(i, score)
+		self._by_pk[pk] = value
+		self._touch(key)
+
+	def set_score(self, pk, score):
+		value = self._by_pk.get(pk)
+		if value is None:
+			return
+		key = self.normalize(value)
+		self.scores[self._position(pk, key)] = score
+		self._touch(key)
+
+	def remove(self, pk):
+		value = self._by_pk.pop(pk, None)
+		if value is None:
+			return
+		key = self.normalize(value)
+		i = self._position(pk, key)
+		del self.keys[i], self.values[i], self.pks[i], self.scores[i]
+		self._touch(key)
+
+
+def benchmark(size=200000, limit=10, repeat=200):
+	'''Время поиска лучших limit значений в зависимости от того, сколько значений
+	подходит под префикс, с запоминанием для коротких префиксов и без него
+	'''
+	import random
+	from time import time
+	alphabet = u'абвгдежзиклмнопрстуфхцчшщэюя'
+	items = [(pk, u''.join(random.choice(alphabet) for i in xrange(8)), random.random())
+			for pk in xrange(size)]
+	plain = PrefixIndex(items, ranked=True, top_size=0)
+	cached = PrefixIndex(items, ranked=True, top_size=limit)
+	print '%8s %10s %14s %14s' % ('prefix', 'matches', 'heap us', 'cached us')
+	for length in xrange(0, 5):
+		prefixes = [value[:length] for pk, value, score in random.sample(items, repeat)]
+		matches = sum(plain.count(prefix) for prefix in prefixes) / repeat
+		timings = []
+		for index in (plain, cached):
+			for prefix in prefixes:
+				index.find(prefix, limit)
+			start = time()
+			for prefix in prefixes:
+				index.find(prefix, limit)
+			timings.append((time() - start) / repeat * 1e6)
+		print '%8s %10s %14.1f %14.1f' % (length, matches, timings[0], timings[1])
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
+	benchmark()
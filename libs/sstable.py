@@ -0,0 +1,172 @@
+#coding=utf-8
+'''Неизменяемая отсортированная таблица строк в файле для поиска по префиксу.
+
+Файл открывается через mmap, поэтому все процессы, которые его читают, делят одну
+копию в page cache, а в памяти процесса остается только сам объект SSTable.
+Формат (все числа - little-endian uint32):
+
+	'SST1', количество строк n, флаги
+	n + 1 смещений ключей в блоке ключей
+	n + 1 смещений значений в блоке значений (нет, если значения совпадают с ключами)
+	блок ключей, блок значений - строки в UTF-8 подряд
+
+Ключи - нормализованные значения (для регистронезависимого поиска - в нижнем регистре)
+в порядке сортировки. Порядок байтов UTF-8 совпадает с порядком символов, поэтому
+префикс ищется бинарным поиском прямо по байтам файла. Файл пишется во временный
+и подменяется через os.rename, так что читатели видят либо старую, либо новую таблицу.
+Модуль не зависит от Django.
+'''
+import mmap
+import os
+import struct
+import tempfile
+from time import time
+
+MAGIC = 'SST1'
+HEADER = struct.Struct('<4sII')
+OFFSET = struct.Struct('<I')
+SAME_VALUES = 1 # флаг: значения совпадают с ключами и не хранятся отдельно
+
+
+def write_table(path, values, case_sensitive=True):
+	'''Записать таблицу различных значений values в файл path
+	'''
+	if case_sensitive:
+		entries = sorted(set((value, value) for value in values if value))
+	else:
+		entries = sorted(set((value.lower(), value) for value in values if value))
+	keys = [key.encode('utf-8') for key, value in entries]
+	flags = SAME_VALUES if case_sensitive else 0
+	columns = [keys] if case_sensitive else [keys, [value.encode('utf-8') for key, value in entries]]
+
+	# свой временный файл у каждого потока и процесса, иначе один может подменить таблицу
+	# файлом, который другой в это время переписывает
+	fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+	f = os.fdopen(fd, 'wb')
+	try:
+		f.write(HEADER.pack(MAGIC, len(entries), flags))
+		for column in columns:
+			offset = 0
+			offsets = [0]
+			for data in column:
+				offset += len(data)
+				offsets.append(offset)
+			f.write(struct.pack('<%sI' % len(offsets), *offsets))
+		for column in columns:
+			f.write(''.join(column))
+		f.flush()
+		os.fsync(f.fileno())
+	except:
+		f.close()
+		os.remove(tmp)
+		raise
+	f.close()
+	# mkstemp создает файл, доступный только владельцу
+	os.chmod(tmp, 0644)
+	os.rename(tmp, path)
+
+
+class Table(object):
+	'''Открытый файл таблицы: mmap и смещения блоков в нем. После создания не меняется,
+	поэтому SSTable подменяет его целиком, одним присваиванием, и поиск, который идет
+	в другом потоке, не смешивает смещения старого файла с новым mmap.
+	'''
+	def __init__(self, path):
+		f = open(path, 'rb')
+		try:
+			stat = os.fstat(f.fileno())
+			self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		self.identity = (stat.st_ino, stat.st_mtime)
+		magic, self.count, flags = HEADER.unpack_from(self.mmap, 0)
+		if magic != MAGIC:
+			raise ValueError('%s is not a string table' % path)
+		self.key_offsets = HEADER.size
+		columns = 1 if flags & SAME_VALUES else 2
+		self.value_offsets = self.key_offsets + (self.count + 1) * OFFSET.size * (columns - 1)
+		self.keys = self.key_offsets + (self.count + 1) * OFFSET.size * columns
+		self.values = self.keys + self._offset(self.key_offsets, self.count) if columns == 2 else self.keys
+		self.case_sensitive = columns == 1
+
+	def _offset(self, table, i):
+		return OFFSET.unpack_from(self.mmap, table + i * OFFSET.size)[0]
+
+	def _key(self, i):
+		return self.mmap[self.keys + self._offset(self.key_offsets, i):
+				self.keys + self._offset(self.key_offsets, i + 1)]
+
+	def _value(self, i):
+		return self.mmap[self.values + self._offset(self.value_offsets, i):
+				self.values + self._offset(self.value_offsets, i + 1)].decode('utf-8')
+
+	def _bisect(self, key, lo=0):
+		hi = self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._key(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def find(self, prefix, limit=None):
+		if not self.case_sensitive:
+			prefix = prefix.lower()
+		prefix = prefix.encode('utf-8')
+		start = self._bisect(prefix)
+		end = self.count if limit is None else min(self.count, start + limit)
+		result = []
+		for i in xrange(start, end):
+			if not self._key(i).startswith(prefix):
+				break
+			result.append(self._value(i))
+		return result
+
+
+class SSTable(object):
+	'''Таблица из write_table. Раз в check_interval секунд проверяет, не подменили ли
+	файл, и если подменили - открывает новый.
+
+	>>> import tempfile
+	>>> path = tempfile.mktemp()
+	>>> write_table(path, [u'Moscow', u'minsk', u'Madrid', u'Moscow'], case_sensitive=False)
+	>>> table = SSTable(path)
+	>>> table.find(u'M')
+	[u'Madrid', u'minsk', u'Moscow']
+	>>> table.find(u'mo'), table.find(u'x'), len(table)
+	([u'Moscow'], [], 3)
+	>>> os.remove(path)
+	'''
+	def __init__(self, path, check_interval=1):
+		self.path = path
+		self.check_interval = check_interval
+		self._table = Table(path)
+		self._checked = time()
+
+	def __len__(self):
+		return self._table.count
+
+	def _maybe_reload(self):
+		now = time()
+		if now - self._checked < self.check_interval:
+			return
+		self._checked = now
+		try:
+			stat = os.stat(self.path)
+		except OSError:
+			return
+		if (stat.st_ino, stat.st_mtime) != self._table.identity:
+			# старый mmap закроется, когда на него не останется ссылок
+			self._table = Table(self.path)
+
+	def find(self, prefix, limit=None):
+		'''Значения, которые начинаются с prefix, в порядке сортировки (не больше limit)
+		'''
+		self._maybe_reload()
+		return self._table.find(prefix, limit)
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,173 @@
+#coding=utf-8
+'''Дешевые счетчики и гистограммы времени в памяти процесса.
+
+Статистика собирается по пространствам имен (например 'cache'), внутри -
+по имени (например 'app.Model.slug__exact') и событию ('hit', 'miss', 'db', ...).
+Раз в STATS_FLUSH_INTERVAL секунд накопленное отдается репортеру из настройки
+STATS_REPORTER (по умолчанию CacheReporter, который складывает статистику
+процессов в общий кеш, откуда ее читает manage.py cache_stats).
+
+Счетчики не защищены блокировкой, поэтому под многопоточным сервером
+изредка могут терять единицы - для настройки кеша это не важно.
+'''
+import logging
+import os
+import socket
+from bisect import bisect_left
+from collections import defaultdict
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+log = logging.getLogger(__name__)
+
+# верхние границы интервалов гистограммы, в миллисекундах; последний интервал - все, что больше
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def percentile(timing, p):
+	'''Оценка p-го процентиля (в миллисекундах) по гистограмме [количество, сумма, интервалы...].
+	Возвращает верхнюю границу интервала, в который он попадает.
+	'''
+	count, buckets = timing[0], timing[2:]
+	if not count:
+		return 0
+	rank = count * p / 100.0
+	seen = 0
+	for i, n in enumerate(buckets):
+		seen += n
+		if seen >= rank:
+			return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+	return float('inf')
+
+
+def merge(snapshot, other):
+	'''Добавить к snapshot (см. Stats.snapshot) данные из other
+	'''
+	for key, value in other['counters'].iteritems():
+		snapshot['counters'][key] = snapshot['counters'].get(key, 0) + value
+	for key, value in other['timings'].iteritems():
+		if key in snapshot['timings']:
+			snapshot['timings'][key] = [a + b for a, b in zip(snapshot['timings'][key], value)]
+		else:
+			snapshot['timings'][key] = list(value)
+	return snapshot
+
+
+class Stats(object):
+	'''Статистика одного пространства имен в текущем процессе
+	'''
+	def __init__(self, namespace):
+		self.namespace = namespace
+		self.enabled = getattr(settings, 'STATS_ENABLED', True)
+		self.flush_interval = getattr(settings, 'STATS_FLUSH_INTERVAL', 60)
+		self.reset()
+
+	def reset(self):
+		self.counters = defaultdict(int)
+		self.timings = {}
+		self.since = self._flushed = time()
+
+	def incr(self, name, event, count=1):
+		if not self.enabled:
+			return
+		self.counters[(name, event)] += count
+		self._maybe_flush()
+
+	def timing(self, name, event, seconds):
+		'''Записать время события в гистограмму
+		'''
+		if not self.enabled:
+			return
+		ms = seconds * 1000
+		try:
+			timing = self.timings[(name, event)]
+		except KeyError:
+			timing = self.timings[(name, event)] = [0, 0.0] + [0] * (len(BUCKETS) + 1)
+		timing[0] += 1
+		timing[1] += ms
+		timing[2 + bisect_left(BUCKETS, ms)] += 1
+		self._maybe_flush()
+
+	def snapshot(self):
+		return {
+			'counters': dict(self.counters),
+			'timings': dict((key, list(value)) for key, value in self.timings.iteritems()),
+		}
+
+	def _maybe_flush(self):
+		if time() - self._flushed > self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		self._flushed = time()
+		try:
+			get_reporter().report(self)
+		except Exception, e:
+			log.error('Stats reporter failed for %s: %s', self.namespace, e)
+
+
+class LogReporter(object):
+	'''Пишет накопленную статистику в лог и обнуляет ее
+	'''
+	def report(self, stats):
+		snapshot = stats.snapshot()
+		for (name, event), count in sorted(snapshot['counters'].iteritems()):
+			log.info('%s %s %s: %s', stats.namespace, name, event, count)
+		for (name, event), timing in sorted(snapshot['timings'].iteritems()):
+			log.info('%s %s %s: %s calls, avg %.2f ms, p99 %s ms', stats.namespace, name, event,
+					timing[0], timing[1] / timing[0], percentile(timing, 99))
+		stats.reset()
+
+
+class CacheReporter(object):
+	'''Хранит статистику каждого процесса под своим ключом в общем кеше.
+
+	Процесс копит статистику с момента последнего сброса и перезаписывает свой ключ,
+	поэтому гонок между процессами нет. collect() складывает статистику всех процессов,
+	reset() удаляет ее и просит процессы обнулить свои счетчики.
+	'''
+	timeout = 60 * 60 * 24
+
+	def _key(self, namespace, suffix):
+		return 'stats.%s.%s' % (namespace, suffix)
+
+	def report(self, stats):
+		reset_at = cache.get(self._key(stats.namespace, 'reset'))
+		if reset_at and reset_at > stats.since:
+			# после reset() начинаем считать заново
+			stats.reset()
+		process_key = self._key(stats.namespace, '%s.%s' % (socket.gethostname(), os.getpid()))
+		cache.set(process_key, stats.snapshot(), self.timeout)
+		index_key = self._key(stats.namespace, 'processes')
+		processes = cache.get(index_key) or set()
+		if process_key not in processes:
+			processes.add(process_key)
+			cache.set(index_key, processes, self.timeout)
+
+	def collect(self, namespace):
+		processes = cache.get(self._key(namespace, 'processes')) or set()
+		snapshot = {'counters': {}, 'timings': {}}
+		for process_snapshot in cache.get_many(list(processes)).itervalues():
+			merge(snapshot, process_snapshot)
+		return snapshot
+
+	def reset(self, namespace):
+		index_key = self._key(namespace, 'processes')
+		processes = cache.get(index_key) or set()
+		cache.delete_many(list(processes) + [index_key])
+		cache.set(self._key(namespace, 'reset'), time(), self.timeout)
+
+
+_reporter = None
+
+
+def get_reporter():
+	global _reporter
+	if _reporter is None:
+		path = getattr(settings, 'STATS_REPORTER', 'libs.stats.CacheReporter')
+		module, name = path.rsplit('.', 1)
+		_reporter = getattr(import_module(module), name)()
+	return _reporter
@@ -77,6 +77,15 @@ from libs.hamlish import HamlishExtension
 ASSETS_JINJA2_EXTENSIONS = JINJA2_EXTENSIONS = [HamlishExtension]
 HAMLISH_MODE = 'debug' if DEBUG else 'compact'
 HAMLISH_DEBUG = DEBUG
+# шаблоны, переведенные из HAML, хранятся здесь и не разбираются заново после перезапуска
+HAMLISH_CACHE_DIR = path.join(PROJECT_ROOT, 'cache', 'hamlish')
+HAMLISH_CACHE_SIZE = 50 * 1024 * 1024
+
+#--- Autocomplete setup.
+# таблицы SQLite FTS5 полей с autocomplete_word_backend = 'fts', общие для всех процессов
+AUTOCOMPLETE_FTS_DIR = path.join(PROJECT_ROOT, 'cache', 'autocomplete')
+# таблицы строк полей с autocomplete_backend = 'sstable' (./manage.py build_autocomplete_tables)
+AUTOCOMPLETE_SSTABLE_DIR = path.join(PROJECT_ROOT, 'cache', 'autocomplete')
 
 
 MIDDLEWARE_CLASSES = (
@@ -124,6 +133,22 @@ NOSE_ARGS = ['--with-color',]
 
 LOGIN_REDIRECT_URL = '/'
 
+#--- Статистика кеша, см. libs/stats.py и ./manage.py cache_stats
+STATS_ENABLED = True
+STATS_FLUSH_INTERVAL = 60
+STATS_REPORTER = 'libs.stats.CacheReporter'
+
+#--- Проверка контрактов @takes/@returns, см. libs/contracts.py
+# 1 - каждый вызов, N - один из N вызовов каждой функции, 0 - не проверять
+CONTRACTS_SAMPLE_RATE = 1
+# выбрасывать исключение при нарушении (по умолчанию - только если проверяется каждый вызов),
+# иначе нарушения считаются и пишутся в лог
+CONTRACTS_RAISE = None
+# сколько элементов list_of/tuple_of/set_of/dict_of проверять, 0 - все
+CONTRACTS_CONTAINER_SAMPLE = 0
+# записывать время проверок и самих функций, см. ./manage.py contracts_profile
+CONTRACTS_PROFILE = False
+
 # --- Logging
 import logging
 LOG_DIR = path.join(PROJECT_ROOT, 'logs')
@@ -138,4 +163,12 @@ except ImportError:
     pass
 
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT,
-        filename=LOG_FILENAME)
\ No newline at end of file
+        filename=LOG_FILENAME)
+
+#--- Байткод шаблонов Jinja2, заранее собранный ./manage.py compile_templates при выкладке
+if not DEBUG:
+    from jinja2 import FileSystemBytecodeCache
+    # jinja сверяет байткод только с исходником, поэтому режим HAML - часть пути
+    JINJA2_BYTECODE_DIR = path.join(PROJECT_ROOT, 'cache', 'jinja2', HAMLISH_MODE)
+    if not path.isdir(JINJA2_BYTECODE_DIR): os.makedirs(JINJA2_BYTECODE_DIR)
+    JINJA2_ENVIRONMENT_OPTIONS = {'bytecode_cache': FileSystemBytecodeCache(JINJA2_BYTECODE_DIR)}